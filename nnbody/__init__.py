@@ -1,4 +1,15 @@
-"""Import at module level."""
-from . import models, features
+"""Import at module level.
+
+Subpackages are imported on first access, so that `nnbody.serving` can be
+used without importing the training package.
+"""
+import importlib
 
 __all__ = ["models", "features"]
+
+
+def __getattr__(name):
+    """Import the subpackage `name` lazily."""
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
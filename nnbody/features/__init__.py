@@ -1,6 +1,36 @@
 """Import of 'public' API."""
 
+from .feature_cache import DistanceCache, FeatureCache
 from .generate import parse_pdb
-from .protein_graph import get_datasets, get_longest
+from .graph_store import GraphStore
+from .neighbors import Neighbors, neighbor_edges
+from .protein_graph import (
+    JitterCollate,
+    PackedBatch,
+    collate_packed,
+    collate_padded,
+    get_datasets,
+    get_folds,
+    get_longest,
+)
+from .res_selector import CDR_RANGES
+from .sampling import AugmentationSampler, BucketBatchSampler
 
-__all__ = ["parse_pdb", "get_longest", "get_datasets"]
+__all__ = [
+    "parse_pdb",
+    "get_longest",
+    "get_datasets",
+    "get_folds",
+    "GraphStore",
+    "FeatureCache",
+    "DistanceCache",
+    "PackedBatch",
+    "collate_packed",
+    "collate_padded",
+    "BucketBatchSampler",
+    "AugmentationSampler",
+    "JitterCollate",
+    "CDR_RANGES",
+    "Neighbors",
+    "neighbor_edges",
+]
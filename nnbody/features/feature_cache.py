@@ -0,0 +1,230 @@
+"""Persistent cache of the feature tensors of a ProteinGraphDataset.
+
+The padded node features, coordinates and node masks of all the graphs of a
+dataset are stored as ``.npy`` files in ``<path>/<key>/`` and memory-mapped
+on read, so new processes skip featurization and concurrent jobs share one
+copy through the page cache. The key is a hash of the source graphs, the
+padding size, the task type, the residue selection and `FEATURE_VERSION`.
+
+`SharedFeatures` holds the same arrays in shared memory instead, for
+processes that do not need them to persist (e.g. DataLoader workers), and
+`DistanceCache` the masked distance matrices of the graphs.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+from scipy.spatial.distance import squareform
+
+from .res_selector import selection_tag
+
+# bump when the features computed by ProteinGraphDataset change
+FEATURE_VERSION = 1
+CACHE_FIELDS = ("v", "c", "m", "n")
+
+
+def cache_key(
+    source_hashes,
+    nb_nodes,
+    task_type,
+    version=FEATURE_VERSION,
+    selection=None,
+):
+    """Hash the ordered `source_hashes` with the feature parameters."""
+    h = hashlib.sha256(f"{version},{nb_nodes},{task_type}".encode())
+    if selection is not None:
+        # residue ranges by chain, see ProteinGraphDataset
+        h.update(selection_tag(selection).encode())
+    for source_hash in source_hashes:
+        h.update(source_hash.encode())
+    return h.hexdigest()
+
+
+class FeatureCache:
+    """On-disk cache of padded feature tensors.
+
+    Fields are "v" (node features), "c" (coordinates), "m" (node mask), all
+    padded to the same number of nodes, and "n" (number of nodes of each
+    graph before padding).
+    """
+
+    def __init__(self, path, key):
+        """Point to the cache `key` in directory `path`."""
+        self.path = path
+        self.key = key
+        self.directory = os.path.join(path, key)
+        self._arrays = None
+
+    def exists(self):
+        """Check if the cache has already been written."""
+        return all(
+            os.path.exists(os.path.join(self.directory, f"{field}.npy"))
+            for field in CACHE_FIELDS
+        )
+
+    def write(self, **arrays):
+        """Write the `arrays` of every field of `CACHE_FIELDS`.
+
+        Files are written to a temporary directory that is then renamed, so
+        readers never see partial caches. If another process wrote the same
+        cache in the meantime, its copy is kept.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.path, prefix=".tmp-")
+        try:
+            for field in CACHE_FIELDS:
+                np.save(os.path.join(tmp, f"{field}.npy"), arrays[field])
+            os.rename(tmp, self.directory)
+        except OSError:
+            if not self.exists():
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self._arrays = None
+
+    @property
+    def arrays(self):
+        """Memory-mapped arrays of the cache, as a dict field -> array."""
+        if self._arrays is None:
+            self._arrays = {
+                field: np.load(
+                    os.path.join(self.directory, f"{field}.npy"),
+                    mmap_mode="r",
+                )
+                for field in CACHE_FIELDS
+            }
+        return self._arrays
+
+    def __getitem__(self, row):
+        """Return the unpadded (v, c, m) of the graph at `row`."""
+        arrays = self.arrays
+        n = arrays["n"][row]
+        return tuple(
+            np.array(arrays[field][row, :n]) for field in CACHE_FIELDS[:-1]
+        )
+
+    def __len__(self):
+        """Retrieve number of cached graphs."""
+        return len(self.arrays["n"])
+
+    def __getstate__(self):
+        """Do not pickle the mappings; workers map the files again."""
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+
+class SharedFeatures:
+    """Feature tensors in shared memory, with the interface of FeatureCache.
+
+    The arrays are stored as contiguous torch tensors moved to shared
+    memory, so DataLoader workers (forked or spawned) read the same physical
+    copy instead of duplicating it.
+    """
+
+    def __init__(self, arrays):
+        """Move `arrays` (a dict field -> array, see FeatureCache) to shm."""
+        self.tensors = {
+            field: torch.from_numpy(
+                np.ascontiguousarray(arrays[field])
+            ).share_memory_()
+            for field in CACHE_FIELDS
+        }
+
+    @property
+    def arrays(self):
+        """Numpy views of the shared tensors, as a dict field -> array."""
+        return {field: t.numpy() for field, t in self.tensors.items()}
+
+    def __getitem__(self, row):
+        """Return the unpadded (v, c, m) of the graph at `row`."""
+        n = int(self.tensors["n"][row])
+        return tuple(
+            self.tensors[field][row, :n].numpy().copy()
+            for field in CACHE_FIELDS[:-1]
+        )
+
+    def __len__(self):
+        """Retrieve number of graphs."""
+        return len(self.tensors["n"])
+
+
+# flat indices of the upper and lower triangles, see `_triangles`
+_TRIANGLES = {}
+
+
+def _triangles(n, size):
+    """Get the flat indices of the triangles of a (n, n) matrix in (size,).
+
+    The matrix is the top left block of a (size, size) array. Indices are
+    cached by (n, size).
+    """
+    if (n, size) not in _TRIANGLES:
+        row, col = np.triu_indices(n, 1)
+        _TRIANGLES[n, size] = row * size + col, col * size + row
+    return _TRIANGLES[n, size]
+
+
+class DistanceCache:
+    """Masked distance matrices of a set of graphs, in shared memory.
+
+    The matrices are concatenated in one tensor of `dtype`, either whole or,
+    with `triangle`, as their strict upper triangles (they are symmetric
+    with a zero diagonal). A float16 triangle cache takes a quarter of the
+    float32 matrices, but rebuilding a matrix from its triangle is slower
+    (~0.1 ms for 150 nodes).
+    """
+
+    def __init__(self, sizes, triangles, dtype=np.float16, triangle=True):
+        """Store the `triangles` of matrices of `sizes` nodes as `dtype`.
+
+        The triangles are condensed distances, as returned by `pdist`.
+        """
+        self.sizes = list(sizes)
+        self.triangle = triangle
+        if triangle:
+            lengths = [n * (n - 1) // 2 for n in self.sizes]
+        else:
+            lengths = [n * n for n in self.sizes]
+            triangles = [
+                squareform(t, checks=False).ravel() if n > 1 else np.zeros(n)
+                for n, t in zip(self.sizes, triangles)
+            ]
+        self.offsets = np.cumsum([0] + lengths)
+        values = np.concatenate([np.zeros(0, dtype)] + list(triangles))
+        self.values = torch.from_numpy(values.astype(dtype)).share_memory_()
+
+    def __getitem__(self, row):
+        """Return the (n, n) float32 distance matrix of the graph at `row`."""
+        return self.matrix(row)
+
+    def matrix(self, row, size=None):
+        """Return the distance matrix of the graph at `row` as float32.
+
+        With `size`, the matrix is zero padded to (size, size) nodes.
+        """
+        n = self.sizes[row]
+        size = n if size is None else max(size, n)
+        values = self.values[self.offsets[row] : self.offsets[row + 1]]
+        values = values.numpy()
+        if not self.triangle:
+            dist = np.zeros((size, size), dtype=np.float32)
+            dist[:n, :n] = values.reshape(n, n)
+            return dist
+        dist = np.zeros(size * size, dtype=np.float32)
+        upper, lower = _triangles(n, size)
+        dist[upper] = values
+        dist[lower] = values
+        return dist.reshape(size, size)
+
+    def __len__(self):
+        """Retrieve number of graphs."""
+        return len(self.sizes)
+
+    @property
+    def nbytes(self):
+        """Size of the stored distances, in bytes."""
+        return self.values.numel() * self.values.element_size()
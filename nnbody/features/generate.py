@@ -9,21 +9,56 @@ BUGS:
 do not match the sequence of the chain. These PDBs are not processed.
 
 """
+import hashlib
 import os
+import warnings
+from multiprocessing import Pool
 
 import click
 import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 
-# from mpi4py import MPI
-from scipy.spatial.distance import cosine, euclidean
-from scipy.stats import percentileofscore as perc
+from nnbody.features.graph_store import (
+    STORE_NAME,
+    GraphStore,
+    GraphStoreWriter,
+    graph_key,
+    merge_stores,
+    store_exists,
+    write_dataset,
+)
+from nnbody.features.pdb_index import open_pdb, read_chain
+from nnbody.features.res_selector import (
+    CDR_RANGES,
+    chain_residue_index,
+    selection_tag,
+)
 
 ###############################################################################
 
+
+class AlignmentWarning(UserWarning):
+    """A chain could not be aligned to its SEQRES records."""
+
+
 # Static Parameters
 seed = 458762  # For random distribution of tasks using MPI
 
+# Build manifest of the graphs, used for incremental generation
+MANIFEST_NAME = "graphs.manifest"
+MANIFEST_COLUMNS = [
+    "key",
+    "all_chains",
+    "first",
+    "selection",
+    "size",
+    "mtime_ns",
+    "sha256",
+    "nb_residues",
+    "diameter",
+]
+
 residues = [
     "ALA",
     "ARG",
@@ -51,15 +86,19 @@ residues = [
 ]
 
 
-def parse_pdb(path, chain, all_chains=False, first=False):
-    """Parse PDB file information.
+def _read_records_legacy(path, chain, all_chains=False, first=False):
+    """Read SEQRES and ATOM records line by line.
 
-    Parameters
-    ----------
-    path: str
-    chain: str
-    all_chains: bool
-    first: bool
+    Reference implementation of :func:`_read_records_columnar`, kept to test
+    the equivalence of both parser engines.
+
+    Returns
+    -------
+    seq_data: list
+        [chain, residue type] for each SEQRES entry
+    complex_data: dict
+        chain -> rows of [residue number, residue type, CA (x, y, z),
+        side-chain centroid (x, y, z)]
 
     """
     # Parse residue, atom type and atomic coordinates
@@ -75,7 +114,7 @@ def parse_pdb(path, chain, all_chains=False, first=False):
     sidechain_data = []
     sidechain_flag = False
     sidechain_counter = 0
-    with open(path, "r") as f:
+    with open_pdb(path, "r") as f:
         lines = f.readlines()
         for row in lines:
             if row[:6] == "SEQRES":
@@ -185,6 +224,309 @@ def parse_pdb(path, chain, all_chains=False, first=False):
                     if not all_chains or first:
                         break
 
+    return seq_data, complex_data
+
+
+def _field(table, start, end):
+    """Slice the columns [`start`, `end`) of a fixed-width byte `table`."""
+    return table[:, start:end].copy().view(f"S{end - start}").ravel()
+
+
+def _read_records_columnar(
+    path, chain, all_chains=False, first=False, use_index=False
+):
+    """Read SEQRES and ATOM records in one bulk pass over `path`.
+
+    The file is loaded as a (lines, 80) byte matrix so that every fixed-width
+    PDB field is a column slice. Atoms are grouped by residue number and the
+    CA coordinates and side-chain centroids are computed with array
+    reductions, reproducing the state machine of :func:`_read_records_legacy`
+    (including its handling of residues without CA, which reuse the last CA
+    seen, and of the first atom of each residue, which is never inspected).
+
+    With `use_index` (and a single chain), only the records of `chain` are
+    read, through the sidecar index of :mod:`pdb_index`.
+
+    Returns
+    -------
+    seq_data, complex_data: as in :func:`_read_records_legacy`
+
+    """
+    if use_index and not all_chains:
+        text = read_chain(path, chain.upper())
+    else:
+        with open_pdb(path, "rb") as f:
+            text = f.read()
+    table = np.array(text.splitlines(), dtype="S80")
+    table = table.view("S1").reshape(-1, 80)
+    record = _field(table, 0, 6)
+    is_atom = np.char.startswith(record, b"ATOM")
+    if not all_chains:
+        is_atom &= _field(table, 21, 22) == chain.upper().encode()
+    atom_rows = np.flatnonzero(is_atom)
+    term_rows = np.flatnonzero(
+        np.char.startswith(record, b"TER") | (record == b"CONECT")
+    )
+    atoms = table[atom_rows]
+    n_atoms = len(atoms)
+    res_index = {r: i for i, r in enumerate(residues)}
+    unk = res_index["UNK"]
+
+    complex_data = {}
+    stop_row = len(table)
+    if n_atoms:
+        # Group atoms by residue number
+        res_num = _field(atoms, 22, 26)
+        new_res = np.ones(n_atoms, dtype=bool)
+        new_res[1:] = res_num[1:] != res_num[:-1]
+        res_id = np.cumsum(new_res) - 1
+        starts = np.flatnonzero(new_res)
+        ends = np.append(starts[1:], n_atoms) - 1
+        nb_res = len(starts)
+        # the atom that opens a residue is only compared, never inspected
+        inspected = ~new_res
+        inspected[0] = True
+        is_ca = np.isin(_field(atoms, 12, 17), [b" CA  ", b" CA A"])
+        is_ca_inspected = is_ca & inspected
+        xyz = np.stack(
+            [
+                np.char.strip(_field(atoms, 30, 38)),
+                np.char.strip(_field(atoms, 38, 46)),
+                np.char.strip(_field(atoms, 47, 54)),
+            ],
+            axis=-1,
+        )
+
+        # CA of the residue (last one seen, possibly from a previous residue)
+        atom_idx = np.arange(n_atoms)
+        first_ca = np.minimum.reduceat(
+            np.where(is_ca_inspected, atom_idx, n_atoms), starts
+        )
+        last_ca = np.maximum.accumulate(
+            np.where(is_ca_inspected, atom_idx, -1)
+        )[ends]
+
+        # Side chain: atoms after CA, skipping the two that follow it
+        is_sc = inspected & ~is_ca & (atom_idx - first_ca[res_id] >= 3)
+        sc_res = res_id[is_sc]
+        sc_xyz = xyz[is_sc].astype(float)
+        sc_count = np.bincount(sc_res, minlength=nb_res)
+        sc_sum = np.stack(
+            [
+                np.bincount(sc_res, weights=sc_xyz[:, k], minlength=nb_res)
+                for k in range(3)
+            ],
+            axis=-1,
+        )
+
+        # Residues are emitted when the next one starts or at TER/CONECT
+        next_term = np.searchsorted(term_rows, atom_rows[ends])
+        next_term_row = np.append(term_rows, len(table))[next_term]
+        next_start_row = np.append(atom_rows[starts[1:]], len(table))
+        term_between = next_term_row < next_start_row
+        on_start = np.flatnonzero(last_ca[:-1] >= 0)
+        on_term = np.flatnonzero(
+            (first_ca < n_atoms) & term_between & (next_term < len(term_rows))
+        )
+        emitted = np.concatenate([on_start, on_term])
+        keys = np.concatenate(
+            [2 * next_start_row[on_start], 2 * next_term_row[on_term]]
+        )
+        with_sc = np.concatenate(
+            [~term_between[on_start], np.ones(len(on_term), dtype=bool)]
+        )
+        order = np.argsort(keys, kind="stable")
+        emitted, keys, with_sc = emitted[order], keys[order], with_sc[order]
+        with_sc &= sc_count[emitted] > 0
+
+        ca = last_ca[emitted]
+        sc = xyz[ca].astype(float)
+        sc[with_sc] = (
+            sc_sum[emitted[with_sc]]
+            / sc_count[emitted[with_sc]][:, np.newaxis]
+        )
+        res_name, res_type = np.unique(
+            _field(atoms[ca], 17, 20), return_inverse=True
+        )
+        res_name = np.array(
+            [res_index.get(r, unk) for r in res_name.astype(str)], dtype=int
+        )
+        rows = np.empty((len(emitted), 8), dtype=object)
+        rows[:, 0] = res_num[starts][emitted].astype(str)
+        rows[:, 1] = res_name[res_type].astype(str)
+        rows[:, 2:5] = xyz[ca].astype(str)
+        rows[:, 5:] = sc
+
+        # Store chains at the TER/CONECT records that close them
+        closed = np.searchsorted(keys, 2 * term_rows + 1)
+        commits = np.flatnonzero(np.diff(closed, prepend=0) > 0)
+        last_atom = np.searchsorted(atom_rows, term_rows) - 1
+        atom_chain = _field(atoms, 21, 22).astype(str)
+        lo = 0
+        for t in commits:
+            curr_chain = atom_chain[last_atom[t]].upper()
+            complex_data[curr_chain] = rows[lo : closed[t]]
+            lo = closed[t]
+            if not all_chains or first:
+                stop_row = term_rows[t]
+                break
+
+    seq_data = []
+    for row in table[:stop_row][record[:stop_row] == b"SEQRES"]:
+        row_ = row.tobytes().decode().rstrip("\x00").split()
+        if not all_chains and row_[2] != chain.upper():
+            continue
+        seq_data += [
+            [row_[2].upper(), res_index.get(_, unk)] for _ in row_[4:]
+        ]
+
+    return seq_data, complex_data
+
+
+def _residue_features(chain_c, chain_sc_c):
+    """Compute depth and side-chain orientation of the residues of a chain.
+
+    Parameters
+    ----------
+    chain_c, chain_sc_c: np.array
+        (residues, 3) coordinates of the CA and of the side-chain centroids
+
+    Returns
+    -------
+    residue_depth_percentile: np.array of str
+        1 - percentile ("rank" kind) of the distance of each CA to the
+        centroid of the chain
+    residue_orientation: np.array of str
+        cosine similarity of the CA -> centroid and CA -> side-chain
+        vectors ("0.0000" if undefined)
+
+    Both as strings truncated to 6 characters.
+
+    """
+    chain_centroid = np.mean(chain_c, axis=0)
+    residue_depth = np.linalg.norm(chain_centroid - chain_c, axis=1)
+    sorted_depth = np.sort(residue_depth)
+    left = np.searchsorted(sorted_depth, residue_depth, side="left")
+    right = np.searchsorted(sorted_depth, residue_depth, side="right")
+    perct = (left + right + (left < right)) * (50.0 / len(residue_depth))
+    residue_depth_percentile = 1 - perct / 100.0
+
+    chain_c = chain_c - chain_centroid
+    chain_sc_c = chain_sc_c - chain_centroid
+    chain_sc_c = chain_sc_c - chain_c
+    chain_c = -(chain_c)
+    # row-wise dot products as stacked (1, 3) @ (3, 1) products
+    uv = np.matmul(chain_c[:, np.newaxis], chain_sc_c[..., np.newaxis])
+    uu = np.matmul(chain_c[:, np.newaxis], chain_c[..., np.newaxis])
+    vv = np.matmul(chain_sc_c[:, np.newaxis], chain_sc_c[..., np.newaxis])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dist = 1.0 - uv[:, 0, 0] / np.sqrt(uu[:, 0, 0] * vv[:, 0, 0])
+    residue_orientation = 1 - np.clip(dist, 0.0, 2.0)
+
+    return (
+        residue_depth_percentile.astype(str).astype("<U6"),
+        np.where(
+            np.isnan(residue_orientation),
+            "0.0000",
+            residue_orientation.astype(str).astype("<U6"),
+        ),
+    )
+
+
+# longest k-mer whose integer codes (< len(residues)^k) fit in an int64
+MAX_ALIGN_K = max(
+    k for k in range(1, 64) if len(residues) ** k <= np.iinfo(np.int64).max
+)
+
+
+def _align_offset(seq, chain_data, k=3, min_k=None):
+    """Compute the offset from crystal residue numbers to SEQRES positions.
+
+    The residue types of `chain_data` are matched against an index of the
+    k-mers of the SEQRES `seq`, each k-mer encoded as an integer. The offset
+    is given by the first k-mer of the chain (in order) found in the
+    sequence, at its first occurrence there. If there is none, shorter
+    k-mers are tried down to `min_k` (default: no fallback). `k` is limited
+    to k-mers whose codes fit in an int64 (see `MAX_ALIGN_K`).
+
+    Returns
+    -------
+    offset: int or None
+        None if the chain could not be aligned
+
+    """
+    if not 0 < k <= MAX_ALIGN_K:
+        raise ValueError(
+            f"k-mers of length {k} cannot be aligned, must be in "
+            f"[1, {MAX_ALIGN_K}]"
+        )
+    seq_types = seq[:, 2].astype(int)
+    seq_pos = seq[:, 1].astype(int)
+    chain_types = chain_data[:, 1].astype(int)
+    chain_num = chain_data[:, 0].astype(int)
+    for k_ in range(k, (k if min_k is None else min_k) - 1, -1):
+        # the last k-mer of both sequences is never considered
+        nb_seq = len(seq_types) - k_
+        nb_chain = len(chain_types) - k_
+        if nb_seq <= 0 or nb_chain <= 0:
+            continue
+        weights = len(residues) ** np.arange(k_)
+        seq_kmers = sliding_window_view(seq_types, k_)[:nb_seq] @ weights
+        chain_kmers = sliding_window_view(chain_types, k_)[:nb_chain] @ weights
+        kmers, first = np.unique(seq_kmers, return_index=True)
+        found = np.minimum(np.searchsorted(kmers, chain_kmers), len(kmers) - 1)
+        offsets = seq_pos[first[found]] - chain_num[:nb_chain]
+        # -1 is kept as the "not aligned" value of the former search
+        aligned = (kmers[found] == chain_kmers) & (offsets != -1)
+        if aligned.any():
+            return int(offsets[np.argmax(aligned)])
+    return None
+
+
+def parse_pdb(
+    path,
+    chain,
+    all_chains=False,
+    first=False,
+    engine="columnar",
+    align_k=3,
+    align_min_k=None,
+    use_index=False,
+):
+    """Parse PDB file information.
+
+    Parameters
+    ----------
+    path: str
+        plain or gzipped (".gz") PDB file
+    chain: str
+    all_chains: bool
+    first: bool
+    engine: str
+        "columnar" reads the records in bulk into fixed-width arrays,
+        "legacy" uses the original line-by-line parser. Default: "columnar"
+    align_k, align_min_k: int
+        length of the residue k-mers used to align the chains to their
+        SEQRES, and shortest length to fall back to. Default: 3, no fallback
+    use_index: bool
+        read only the records of `chain` through the sidecar chain index of
+        the PDB, built on first use (columnar engine). Default: False
+
+    Chains that cannot be aligned are reported with an `AlignmentWarning`
+    and no data is returned.
+
+    """
+    if engine == "columnar":
+        seq_data, complex_data = _read_records_columnar(
+            path, chain, all_chains, first, use_index
+        )
+    elif engine == "legacy":
+        seq_data, complex_data = _read_records_legacy(
+            path, chain, all_chains, first
+        )
+    else:
+        raise ValueError(f"Parser engine {engine} unknown")
+
     if len(complex_data) == 0:
         return []
     # No Sequence Data
@@ -242,64 +584,46 @@ def parse_pdb(path, chain, all_chains=False, first=False):
     for i in data.keys():
         data[i] = data[i].astype("int").astype("str")
 
+    failed = []
     for ii in complex_data.keys():
         chain_data = np.array(complex_data[ii])
         chain_c = chain_data[:, 2:5].astype("float")
         chain_sc_c = chain_data[:, 5:].astype("float")
-        chain_centroid = np.mean(chain_c, axis=0)
-        residue_depth = np.array(
-            [euclidean(chain_centroid, c) for c in chain_c]
+        residue_depth_percentile, residue_orientation = _residue_features(
+            chain_c, chain_sc_c
         )
-        residue_depth_percentile = [
-            1 - perc(residue_depth, d) / 100.0 for d in residue_depth
-        ]
-        chain_c = chain_c - chain_centroid
-        chain_sc_c = chain_sc_c - chain_centroid
-        chain_sc_c = chain_sc_c - chain_c
-        chain_c = -(chain_c)
-        residue_orientation = [
-            1 - cosine(chain_c[i], chain_sc_c[i]) for i in range(len(chain_c))
-        ]
 
         if ii not in data:
             continue
 
-        # Try First three res align
-        offset = -1
-        for j in range(len(chain_data) - 3):
-            for i, _ in enumerate(data[ii][:-3]):
-                if (
-                    data[ii][i : i + 3, 2].tolist()
-                    == chain_data[j : j + 3, 1].tolist()
-                ):
-                    offset = int(data[ii][i, 1]) - int(chain_data[j, 0])
-                    break
-            if offset != -1:
-                break
+        # Align residue numbers to the sequence
+        offset = _align_offset(data[ii], chain_data, align_k, align_min_k)
+        if offset is None:
+            failed.append(ii)
+            continue
 
-        if offset == -1:
-            return []
+        # Residues until the first one past the sequence, last one wins
+        ir = chain_data[:, 0].astype(int) - 1 + offset
+        past = np.flatnonzero(ir >= len(data[ii]))
+        mapped = np.arange(past[0] if len(past) else len(ir))
+        mapped = mapped[ir[mapped] >= 0][::-1]
+        mapped = mapped[np.unique(ir[mapped], return_index=True)[1]]
+        data[ii][ir[mapped], 0] = 1
+        data[ii][ir[mapped], 3] = residue_depth_percentile[mapped]
+        data[ii][ir[mapped], -3:] = chain_data[mapped, 2:5]
+        data[ii][ir[mapped], 4] = residue_orientation[mapped]
 
-        for i in range(len(chain_data)):
-            ir = int(chain_data[i][0]) - 1 + offset
-            if ir >= len(data[ii]):
-                break
-            if ir < 0:
-                continue
-            data[ii][ir, 0] = 1
-            data[ii][ir, 3] = str(residue_depth_percentile[i])[:6]
-            data[ii][ir, -3:] = chain_data[i, 2:5]
-            if np.isnan(residue_orientation[i]):
-                data[ii][ir, 4] = "0.0000"
-            else:
-                data[ii][ir, 4] = str(residue_orientation[i])[:6]
+        # Unmapped residues take the coordinates of the last mapped one
+        last = np.where(data[ii][:, 0] == "1", np.arange(len(data[ii])), 0)
+        data[ii][:, -3:] = data[ii][np.maximum.accumulate(last), -3:]
 
-        tmp = 0
-        for i, _ in enumerate(data[ii]):
-            if data[ii][i, 0] == "1":
-                tmp = i
-            else:
-                data[ii][i, -3:] = data[ii][tmp, -3:]
+    if failed:
+        warnings.warn(
+            f"{path}: chains {', '.join(failed)} could not be aligned to "
+            "their SEQRES records",
+            AlignmentWarning,
+        )
+        return []
 
     data = np.concatenate([data[ii] for ii in data.keys()], axis=0)
     if len(data) == 0:
@@ -308,109 +632,462 @@ def parse_pdb(path, chain, all_chains=False, first=False):
     return data
 
 
-@click.command()
-@click.argument(
-    "datafolder", type=click.Path(exists=True),
-)
-@click.option("-v", "--verbose", is_flag=True, help="Enables verbose mode")
-def main(datafolder, verbose):
-    # Parse the command line
-    data_folder = datafolder
-    if data_folder[-1] != "/":
-        data_folder += "/"
-    all_chains = False  # Generate graph for all chains found in PDB
-    first = False  # Collect only the first chain of in PDB
-    if first:
-        all_chains = True
+def _pdb_path(data_folder, pdb_id):
+    """Locate the PDB of `pdb_id` in "pdb", plain or gzipped."""
+    path = data_folder + "pdb/" + pdb_id + ".pdb"
+    if not os.path.exists(path) and os.path.exists(path + ".gz"):
+        return path + ".gz"
+    return path
 
-    # MPI init
-    # comm = MPI.COMM_WORLD
-    # rank = comm.Get_rank()
-    # cores = comm.Get_size()
-
-    # MPI task distribution
-    # if rank == 0:
-    tasks = []
-    with open(data_folder + "data.csv", "r") as f:
-        for i, _ in enumerate(f):
-            row = _[:-1].split(",")
-            tasks.append([row[0], row[1]])
-
-    if not os.path.exists(data_folder + "graph"):
-        os.mkdir(data_folder + "graph")
-
-    # Shuffle for Random Distribution
-    np.random.seed(seed)
-    np.random.shuffle(tasks)
-
-    # else:
-    #     tasks = None
-
-    # Broadcast tasks to all nodes and select tasks according to rank
-    # tasks = comm.bcast(tasks, root=0)
-    # tasks = np.array_split(tasks, cores)[rank]
-
-    # Fetch PDBs
-    prime_lens = []
-    diameters = []
-    fails = 0
+
+def _fingerprint(path):
+    """Compute size, modification time and SHA-256 of file `path`."""
+    st = os.stat(path)
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return st.st_size, st.st_mtime_ns, sha.hexdigest()
+
+
+def _read_manifest(path):
+    """Read the build manifest of graph directory `path`, if any."""
+    manifest = {}
+    if not os.path.exists(os.path.join(path, MANIFEST_NAME)):
+        return manifest
+    with open(os.path.join(path, MANIFEST_NAME), "r") as f:
+        next(f)
+        for line in f:
+            row = line[:-1].split(",")
+            if len(row) < len(MANIFEST_COLUMNS):
+                # written before the residue selection was recorded
+                row.insert(3, "")
+            manifest[row[0]] = [
+                row[0],
+                bool(int(row[1])),
+                bool(int(row[2])),
+                row[3],
+                int(row[4]),
+                int(row[5]),
+                row[6],
+                int(row[7]),
+                float(row[8]),
+            ]
+    return manifest
+
+
+def _write_manifest(path, manifest):
+    """Write the build `manifest` of graph directory `path`."""
+    with open(os.path.join(path, MANIFEST_NAME), "w") as f:
+        f.write(",".join(MANIFEST_COLUMNS) + "\n")
+        for row in manifest.values():
+            f.write(
+                "{},{:d},{:d},{},{},{},{},{},{!r}\n".format(
+                    *row[:-1], float(row[-1])
+                )
+            )
+
+
+def _stale_tasks(
+    tasks, manifest, data_folder, all_chains, first, text, selection=None
+):
+    """Select the `tasks` whose graph must be (re)generated.
+
+    A graph is still valid if the manifest has an entry for it generated
+    with the same parser parameters and residue `selection`, its output
+    exists and the PDB content
+    is unchanged. Content is only hashed when the size or modification time
+    of the file differ from the manifest (which is updated in place).
+    """
+    graph_path = data_folder + "graph"
+    index = GraphStore(graph_path).index if store_exists(graph_path) else {}
+    stale = []
+    for t in tasks:
+        pdb_id = t[0].lower()
+        chain_id = t[1]
+        key = graph_key(pdb_id, chain_id)
+        pdb = _pdb_path(data_folder, pdb_id)
+        if not os.path.exists(pdb):
+            manifest.pop(key, None)
+        entry = manifest.get(key)
+        if entry is None:
+            stale.append(t)
+            continue
+        _, all_chains_, first_, selection_, size, mtime_ns, sha = entry[:7]
+        nb_residues = entry[-2]
+        params = (
+            all_chains or chain_id == "0",
+            first,
+            selection_tag(selection),
+        )
+        outputs = nb_residues == 0 or (
+            key in index
+            and (not text or os.path.exists(f"{graph_path}/{key}.txt"))
+        )
+        if params != (all_chains_, first_, selection_) or not outputs:
+            stale.append(t)
+            continue
+        st = os.stat(pdb)
+        if (st.st_size, st.st_mtime_ns) == (size, mtime_ns):
+            continue
+        fingerprint = _fingerprint(pdb)
+        if fingerprint[::2] == (size, sha):
+            entry[5] = fingerprint[1]
+        else:
+            stale.append(t)
+    return stale
+
+
+def stream_graphs(
+    tasks,
+    data_folder,
+    all_chains=False,
+    first=False,
+    engine="columnar",
+    use_index=False,
+    verbose=False,
+    selection=None,
+):
+    """Parse the PDBs of `tasks` one at a time, yielding their graphs.
+
+    Each PDB is parsed, its residues selected and its graph yielded before
+    the next one is read, so memory is bounded by the largest protein.
+
+    Parameters
+    ----------
+    tasks: Iterable of [pdb_id, chain_id]
+    data_folder: str
+        with a "pdb" directory for the inputs
+    all_chains, first: bool
+        as in :func:`parse_pdb`. Chain "0" always uses all chains
+    engine: str
+        parser engine of :func:`parse_pdb`
+    use_index: bool
+        read single chains through the sidecar index of each PDB
+    verbose: bool
+    selection: dict
+        keep only the residues in these ranges of each chain (e.g.
+        `CDR_RANGES`), see `res_selector.chain_residue_index`. Graphs of
+        several chains get the ranges of each of their chains. Default: all
+        residues (None)
+
+    Yields
+    ------
+    key: str
+        store key of the graph, see `graph_key`
+    record: list
+        manifest entry (see `MANIFEST_COLUMNS`) of the PDB, with 0 residues
+        if no graph could be generated. None if the PDB was not found
+    protein_data: np.array
+        (residues, 10) graph, as str; empty if no graph was generated
+
+    """
     for t in tasks:
 
         # Task IDs
         pdb_id = t[0].lower()
         chain_id = t[1]
-        filename = pdb_id + "_" + chain_id.lower() + ".txt"
+        key = graph_key(pdb_id, chain_id)
 
-        # Use all chains
         if verbose:
             print("Generating: {} chain {}...".format(pdb_id, chain_id))
-        if chain_id == "0":
-            all_chains = True
 
         # Parse PDB
-        if not os.path.exists(data_folder + "pdb/" + pdb_id + ".pdb"):
-            fails += 1
+        pdb = _pdb_path(data_folder, pdb_id)
+        if not os.path.exists(pdb):
             if verbose:
                 print("PDB not found: " + pdb_id + ".pdb")
+            yield key, None, []
             continue
-        protein_data = parse_pdb(
-            data_folder + "pdb/" + pdb_id + ".pdb", chain_id, all_chains, False
-        )
+        record = [
+            key,
+            all_chains or chain_id == "0",
+            first,
+            selection_tag(selection),
+            *_fingerprint(pdb),
+        ]
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always", AlignmentWarning)
+            protein_data = parse_pdb(
+                pdb,
+                chain_id,
+                all_chains or chain_id == "0",
+                first,
+                engine,
+                use_index=use_index,
+            )
+        for w in caught:
+            if verbose and issubclass(w.category, AlignmentWarning):
+                print("NOT ALIGNED: ", pdb_id, ",", chain_id)
+            warnings.warn_explicit(w.message, w.category, w.filename, w.lineno)
+        if selection is not None and len(protein_data) > 0:
+            protein_data = protein_data[
+                chain_residue_index(
+                    protein_data[:, 1].astype(int), selection, chain_id.upper()
+                )
+            ]
         if len(protein_data) == 0:
-            fails += 1
             if verbose:
                 print("NO DATA: ", pdb_id, ",", chain_id)
+            yield key, record + [0, 0.0], []
             continue
-        prime_lens.append(len(protein_data))
         dia = protein_data[:, -3:].astype("float")
         dia = dia - np.mean(dia, axis=0)
         dia = np.max(np.abs(dia)) * 2
-        diameters.append(dia)
-
-        # Save graph
-        with open(data_folder + "graph/" + filename, "w") as f:
-            for i, _ in enumerate(protein_data):
-                f.write(" ".join(_) + "\n")
-
-    # Print graph size stats
-    prime_lens = np.expand_dims(prime_lens, axis=-1).astype("int")
-    diameters = np.expand_dims(diameters, axis=-1)
-    stats = np.concatenate([prime_lens, diameters], axis=-1)
-
-    # Gather stats
-    # stats_ = comm.gather(stats, root=0)
-    # fails_ = comm.gather(fails, root=0)
-
-    # if rank == 0:
-    if verbose:
-        print("NUMBER OF FAILED GENERATIONS: ", sum(fails))
-    stats = np.concatenate(stats, axis=0)
-    df = pd.DataFrame(stats)
-    df.columns = ["nb_residues", "diameters"]
-    summary = df.describe(percentiles=[0.1 * i for i in range(10)])
-    summary.to_csv(
-        data_folder + "/graph.summary", float_format="%1.6f", sep=","
-    )
+        yield key, record + [len(protein_data), dia], protein_data
+
+
+def _featurize(
+    tasks,
+    data_folder,
+    all_chains,
+    first,
+    engine,
+    use_index,
+    verbose,
+    store,
+    text,
+    selection=None,
+):
+    """Parse the PDBs of `tasks` and save their graphs in `data_folder`.
+
+    The graphs of `stream_graphs` are appended to the store as they are
+    parsed.
+
+    Parameters
+    ----------
+    tasks, data_folder, all_chains, first, engine, use_index, verbose,
+    selection:
+        see :func:`stream_graphs`
+    store: str
+        name of the packed graph store to write in "graph"
+    text: bool
+        also export each graph as a "graph/<pdb>_<chain>.txt" text file
+
+    Returns
+    -------
+    records: list
+        manifest entry (see `MANIFEST_COLUMNS`) of every parsed PDB, with
+        0 residues if no graph could be generated
+    fails: int
+        number of tasks that could not be generated
+
+    """
+    records = []
+    fails = 0
+    with GraphStoreWriter(data_folder + "graph", store) as writer:
+        for key, record, protein_data in stream_graphs(
+            tasks,
+            data_folder,
+            all_chains,
+            first,
+            engine,
+            use_index,
+            verbose,
+            selection,
+        ):
+            if record is not None:
+                records.append(record)
+            if len(protein_data) == 0:
+                fails += 1
+                continue
+
+            # Save graph
+            writer.write(key, protein_data)
+            if text:
+                with open(data_folder + f"graph/{key}.txt", "w") as f:
+                    for i, _ in enumerate(protein_data):
+                        f.write(" ".join(_) + "\n")
+
+    return records, fails
+
+
+def _dataset_rows(graph_path, rows, manifest):
+    """Build the dataset manifest of the data.csv `rows` with a graph."""
+    store = GraphStore(graph_path)
+    rows = [
+        row
+        for row in rows
+        if graph_key(*row[:2]) in store
+        and manifest.get(graph_key(*row[:2]), [0, 0])[-2] > 0
+    ]
+    index = [store.index[graph_key(*row[:2])] for row in rows]
+    ends = [offset + nb_residues - 1 for offset, nb_residues in index]
+    lengths = store.graphs[ends, 1].astype(int) if ends else []
+    return [
+        [
+            pdb_id,
+            chain_id,
+            nb_residues,
+            int(length),
+            float(manifest[graph_key(pdb_id, chain_id)][-1]),
+            label,
+            offset,
+        ]
+        for (pdb_id, chain_id, label), (offset, nb_residues), length in zip(
+            rows, index, lengths
+        )
+    ]
+
+
+@click.command()
+@click.argument(
+    "datafolder", type=click.Path(exists=True),
+)
+@click.option("-v", "--verbose", is_flag=True, help="Enables verbose mode")
+@click.option(
+    "--engine",
+    type=click.Choice(["columnar", "legacy"]),
+    default="columnar",
+    help="PDB parser engine",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=None,
+    help="Number of local worker processes. Default: all CPUs",
+)
+@click.option(
+    "--mpi", is_flag=True, help="Distribute tasks over MPI ranks instead"
+)
+@click.option(
+    "--text", is_flag=True, help="Also export graphs as one text file each"
+)
+@click.option(
+    "-i",
+    "--incremental",
+    is_flag=True,
+    help="Only regenerate graphs of new or modified PDBs",
+)
+@click.option(
+    "--index",
+    is_flag=True,
+    help="Read single chains through a sidecar chain index of each PDB",
+)
+@click.option(
+    "--cdr",
+    is_flag=True,
+    help="Keep only the residues of the CDR loops of each chain",
+)
+def main(
+    datafolder, verbose, engine, jobs, mpi, text, incremental, index, cdr
+):
+    # Parse the command line
+    data_folder = datafolder
+    if data_folder[-1] != "/":
+        data_folder += "/"
+    all_chains = False  # Generate graph for all chains found in PDB
+    first = False  # Collect only the first chain of in PDB
+    if first:
+        all_chains = True
+    selection = CDR_RANGES if cdr else None
+
+    # MPI init
+    if mpi:
+        from mpi4py import MPI
+
+        comm = MPI.COMM_WORLD
+        rank = comm.Get_rank()
+        cores = comm.Get_size()
+    else:
+        rank = 0
+        cores = jobs if jobs is not None else os.cpu_count()
+
+    # Task distribution
+    if rank == 0:
+        tasks = []
+        rows = []
+        with open(data_folder + "data.csv", "r") as f:
+            for i, _ in enumerate(f):
+                row = _[:-1].split(",")
+                tasks.append([row[0], row[1]])
+                rows.append([row[0], row[1], row[2] if len(row) > 2 else ""])
+        keys = [graph_key(*t) for t in tasks]
+
+        if not os.path.exists(data_folder + "graph"):
+            os.mkdir(data_folder + "graph")
+
+        manifest = {}
+        if incremental:
+            manifest = _read_manifest(data_folder + "graph")
+            tasks = _stale_tasks(
+                tasks,
+                manifest,
+                data_folder,
+                all_chains,
+                first,
+                text,
+                selection,
+            )
+            if verbose:
+                print("GRAPHS TO GENERATE: ", len(tasks))
+
+        # Shuffle for Random Distribution
+        np.random.seed(seed)
+        np.random.shuffle(tasks)
+
+    else:
+        tasks = None
+
+    args = (data_folder, all_chains, first, engine, index, verbose)
+    shards = [f"{STORE_NAME}.{i}" for i in range(cores)]
+    if mpi:
+        # Broadcast tasks to all nodes and select tasks according to rank
+        tasks = comm.bcast(tasks, root=0)
+        tasks = np.array_split(tasks, cores)[rank]
+        records, fails = _featurize(
+            tasks, *args, shards[rank], text, selection
+        )
+
+        # Gather stats
+        records_ = comm.gather(records, root=0)
+        fails_ = comm.gather(fails, root=0)
+    elif cores > 1:
+        # One shard per local worker
+        with Pool(cores) as pool:
+            results = pool.starmap(
+                _featurize,
+                [
+                    (shard, *args, name, text, selection)
+                    for shard, name in zip(
+                        np.array_split(tasks, cores), shards
+                    )
+                ],
+            )
+        records_, fails_ = zip(*results)
+    else:
+        shards = shards[:1]
+        records, fails = _featurize(tasks, *args, shards[0], text, selection)
+        records_, fails_ = [records], [fails]
+
+    if rank == 0:
+        merge_stores(data_folder + "graph", shards, append=incremental)
+        for records in records_:
+            manifest.update((record[0], record) for record in records)
+        _write_manifest(data_folder + "graph", manifest)
+        write_dataset(
+            data_folder + "graph",
+            _dataset_rows(data_folder + "graph", rows, manifest),
+        )
+        if verbose:
+            print("NUMBER OF FAILED GENERATIONS: ", sum(fails_))
+
+        # Graph size stats of all the graphs of data.csv
+        stats = np.array(
+            [
+                manifest[key][-2:]
+                for key in dict.fromkeys(keys)
+                if key in manifest and manifest[key][-2] > 0
+            ]
+        ).reshape(-1, 2)
+        df = pd.DataFrame(stats)
+        df.columns = ["nb_residues", "diameters"]
+        df["nb_residues"] = df["nb_residues"].astype("int")
+        summary = df.describe(percentiles=[0.1 * i for i in range(10)])
+        summary.to_csv(
+            data_folder + "/graph.summary", float_format="%1.6f", sep=","
+        )
 
 
 if __name__ == "__main__":
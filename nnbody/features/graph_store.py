@@ -0,0 +1,235 @@
+"""Packed on-disk storage of protein graphs.
+
+All the graphs of a dataset are stored as the rows of one contiguous float64
+array of `NB_COLUMNS` columns (the output of `generate.parse_pdb`) in a raw
+``<name>.bin`` file, which is memory-mapped on read. ``<name>.index`` maps
+each "<pdb>_<chain>" key to the offset and number of residues of its graph.
+
+The dataset manifest (`DATASET_NAME`) lists the graphs of each row of
+"data.csv" with their sizes, labels and offsets in the store, so splits can
+be built without touching the graphs.
+"""
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+NB_COLUMNS = 10
+STORE_NAME = "graphs"
+# fraction of unused rows above which an appended store is compacted
+COMPACT_RATIO = 0.25
+DATASET_NAME = "dataset.csv"
+# "length" is the sequence position of the last residue (see get_longest)
+DATASET_COLUMNS = [
+    "id",
+    "chain",
+    "nb_residues",
+    "length",
+    "diameter",
+    "label",
+    "offset",
+]
+
+
+def graph_key(pdb_id, chain_id):
+    """Build the store key of a graph (the stem of its text file)."""
+    return f"{pdb_id.lower()}_{chain_id.lower()}"
+
+
+def store_exists(path, name=STORE_NAME):
+    """Check if there is a packed store `name` in directory `path`."""
+    return os.path.exists(os.path.join(path, name + ".index"))
+
+
+def dataset_exists(path):
+    """Check if there is a dataset manifest in directory `path`."""
+    return os.path.exists(os.path.join(path, DATASET_NAME))
+
+
+def read_dataset(path):
+    """Read the dataset manifest of directory `path` as a DataFrame."""
+    return pd.read_csv(
+        os.path.join(path, DATASET_NAME),
+        dtype={"id": object, "chain": object, "label": object},
+        keep_default_na=False,
+    )
+
+
+def write_dataset(path, rows):
+    """Write the dataset manifest `rows` (see `DATASET_COLUMNS`)."""
+    with open(os.path.join(path, DATASET_NAME), "w") as f:
+        f.write(",".join(DATASET_COLUMNS) + "\n")
+        for row in rows:
+            f.write("{},{},{:d},{:d},{!r},{},{:d}\n".format(*row))
+
+
+def _read_index(path, name):
+    """Read the index of store `name` as a dict key -> (offset, length)."""
+    index = {}
+    with open(os.path.join(path, name + ".index"), "r") as f:
+        next(f)
+        for line in f:
+            key, offset, nb_residues = line[:-1].split(",")
+            index[key] = (int(offset), int(nb_residues))
+    return index
+
+
+def _write_index(path, name, index):
+    """Write the dict `index` of store `name`."""
+    with open(os.path.join(path, name + ".index"), "w") as f:
+        f.write("key,offset,nb_residues\n")
+        for key, (offset, nb_residues) in index.items():
+            f.write(f"{key},{offset},{nb_residues}\n")
+
+
+class GraphStoreWriter:
+    """Append graphs to a packed store, writing its index on close."""
+
+    def __init__(self, path, name=STORE_NAME):
+        """Open the store `name` in directory `path` for writing."""
+        self.path = path
+        self.name = name
+        self.index = {}
+        self.offset = 0
+        self.f = open(os.path.join(path, name + ".bin"), "wb")
+
+    def write(self, key, protein_data):
+        """Append the graph `protein_data` (str or float array) as `key`."""
+        graph = np.asarray(protein_data, dtype=float).reshape(-1, NB_COLUMNS)
+        self.f.write(graph.tobytes())
+        self.index[key] = (self.offset, len(graph))
+        self.offset += len(graph)
+
+    def close(self):
+        """Flush the graphs and write the index."""
+        self.f.close()
+        _write_index(self.path, self.name, self.index)
+
+    def __enter__(self):
+        """Use as a context manager."""
+        return self
+
+    def __exit__(self, *exc):
+        """Close on exit of the context."""
+        self.close()
+
+
+def merge_stores(path, parts, name=STORE_NAME, append=False):
+    """Concatenate the stores `parts` of `path` into `name`, removing them.
+
+    Used to join the shards written by parallel workers. Data is streamed
+    file to file, so memory does not scale with the size of the dataset.
+    With `append`, the parts are added at the end of an existing store and
+    replace its entries with the same key. Their old rows are left unused
+    until they make up more than `COMPACT_RATIO` of the store, which is
+    then compacted (see `compact_store`).
+    """
+    bin_file = os.path.join(path, name + ".bin")
+    if append and store_exists(path, name):
+        index = _read_index(path, name)
+        offset = os.path.getsize(bin_file) // (8 * NB_COLUMNS)
+        mode = "ab"
+    elif len(parts) == 1:
+        os.replace(os.path.join(path, parts[0] + ".bin"), bin_file)
+        os.replace(
+            os.path.join(path, parts[0] + ".index"),
+            os.path.join(path, name + ".index"),
+        )
+        return
+    else:
+        index = {}
+        offset = 0
+        mode = "wb"
+    with open(bin_file, mode) as fout:
+        for part in parts:
+            bin_part = os.path.join(path, part + ".bin")
+            with open(bin_part, "rb") as fin:
+                shutil.copyfileobj(fin, fout)
+            part_index = _read_index(path, part)
+            for key, (part_offset, nb_residues) in part_index.items():
+                index[key] = (offset + part_offset, nb_residues)
+            offset += os.path.getsize(bin_part) // (8 * NB_COLUMNS)
+            os.remove(bin_part)
+            os.remove(os.path.join(path, part + ".index"))
+    _write_index(path, name, index)
+    live = sum(nb_residues for _, nb_residues in index.values())
+    if offset - live > COMPACT_RATIO * offset:
+        compact_store(path, name)
+
+
+def compact_store(path, name=STORE_NAME):
+    """Rewrite store `name` of `path` with only the rows of its index.
+
+    Graphs keep the order of their offsets. The new files are written next
+    to the old ones and then renamed over them.
+    """
+    index = _read_index(path, name)
+    store = GraphStore(path, name, index)
+    new_index = {}
+    offset = 0
+    bin_tmp = os.path.join(path, f".tmp-{name}.bin")
+    with open(bin_tmp, "wb") as fout:
+        for key, (_, nb_residues) in sorted(
+            index.items(), key=lambda item: item[1][0]
+        ):
+            fout.write(np.ascontiguousarray(store[key]).tobytes())
+            new_index[key] = (offset, nb_residues)
+            offset += nb_residues
+    del store
+    _write_index(path, f".tmp-{name}", new_index)
+    os.replace(bin_tmp, os.path.join(path, name + ".bin"))
+    os.replace(
+        os.path.join(path, f".tmp-{name}.index"),
+        os.path.join(path, name + ".index"),
+    )
+
+
+class GraphStore:
+    """Read-only access to a packed store.
+
+    Indexing with a key returns a zero-copy slice of the memory-mapped array.
+    """
+
+    def __init__(self, path, name=STORE_NAME, index=None):
+        """Load the index of store `name` in directory `path`.
+
+        A known `index` (dict key -> (offset, number of residues), e.g. from
+        the dataset manifest) can be given instead of reading it.
+        """
+        self.path = path
+        self.name = name
+        self.index = _read_index(path, name) if index is None else index
+        self._graphs = None
+
+    @property
+    def graphs(self):
+        """All graphs as a (total residues, NB_COLUMNS) memory-mapped array."""
+        if self._graphs is None:
+            bin_file = os.path.join(self.path, self.name + ".bin")
+            if os.path.getsize(bin_file) == 0:
+                self._graphs = np.zeros((0, NB_COLUMNS))
+            else:
+                self._graphs = np.memmap(
+                    bin_file, dtype=float, mode="r"
+                ).reshape(-1, NB_COLUMNS)
+        return self._graphs
+
+    def __getitem__(self, key):
+        """Return the (nb_residues, NB_COLUMNS) graph of `key`."""
+        offset, nb_residues = self.index[key]
+        return self.graphs[offset : offset + nb_residues]
+
+    def __contains__(self, key):
+        """Check if the graph `key` is in the store."""
+        return key in self.index
+
+    def __len__(self):
+        """Retrieve number of graphs."""
+        return len(self.index)
+
+    def __getstate__(self):
+        """Do not pickle the mapping; workers map the file again."""
+        state = self.__dict__.copy()
+        state["_graphs"] = None
+        return state
@@ -0,0 +1,72 @@
+"""Sparse neighbor graphs of the residues of a protein.
+
+Instead of connecting every pair of (masked) residues, each residue is
+connected to the residues within a distance `cutoff` and/or to its `k`
+nearest ones, found with a KD-tree. The resulting adjacencies have O(nodes)
+edges, so sparse graph convolutions cost O(edges) instead of O(nodes^2).
+"""
+
+from collections import namedtuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# neighbor graph parameters, see `neighbor_edges`
+Neighbors = namedtuple("Neighbors", ["cutoff", "k"], defaults=(None, None))
+
+
+def neighbor_edges(c, m=None, cutoff=None, k=None):
+    """Find the neighbors of each node of a graph.
+
+    Parameters
+    ----------
+    c: np.array
+        (nodes, 3) coordinates
+    m: np.array
+        (nodes,) node mask; only nodes with m != 0 are connected. Default:
+        all nodes (None)
+    cutoff: float
+        connect the nodes at a distance <= `cutoff`
+    k: int
+        connect each node to its `k` nearest neighbors (within `cutoff`, if
+        given). The edges then go from each node to its neighbors and the
+        adjacency is not symmetric
+
+    Returns
+    -------
+    edges: np.array
+        (2, edges) indices of the neighbor pairs, sorted, without self loops
+    dist: np.array
+        (edges,) distance between the nodes of each edge
+
+    """
+    if cutoff is None and k is None:
+        raise ValueError("Neighbors need a cutoff and/or a number k")
+    c = np.asarray(c, dtype=float)
+    nodes = np.arange(len(c)) if m is None else np.flatnonzero(m)
+    if len(nodes) < 2:
+        return np.zeros((2, 0), dtype=np.int64), np.zeros(0)
+    points = c[nodes]
+    tree = cKDTree(points)
+    if k is None:
+        pairs = tree.query_pairs(cutoff, output_type="ndarray")
+        row = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        col = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    else:
+        nb_queried = min(k + 1, len(points))
+        _, col = tree.query(
+            points,
+            nb_queried,
+            distance_upper_bound=np.inf if cutoff is None else cutoff,
+        )
+        col = col.reshape(len(points), nb_queried)
+        row = np.repeat(np.arange(len(points)), nb_queried).reshape(col.shape)
+        # missing neighbors get index len(points); the node itself is not
+        # always the first one if others are at distance 0
+        valid = (col < len(points)) & (col != row)
+        valid &= np.cumsum(valid, axis=1) <= k
+        row, col = row[valid], col[valid]
+    order = np.lexsort((col, row))
+    row, col = row[order], col[order]
+    dist = np.linalg.norm(points[row] - points[col], axis=1)
+    return np.stack([nodes[row], nodes[col]]).astype(np.int64), dist
@@ -0,0 +1,215 @@
+"""Sidecar index of the chains of a PDB file.
+
+For every chain, the index stores the byte ranges of its SEQRES, HELIX and
+SHEET records and of its ATOM block (up to the TER/CONECT record closing it),
+so that a single chain can be read without scanning the whole file. It is
+saved as JSON next to the PDB (``<path>.idx``) and rebuilt when the PDB
+changes.
+
+Gzipped PDBs (``.pdb.gz``) are indexed by uncompressed offsets plus the
+offsets of their gzip members, so reads start decompressing at the member
+containing the chain. Blocked gzip files (many members, as written by
+``bgzip``) get true block-level seeks; a single-member file is decompressed
+from its start but only up to the end of the chain.
+"""
+import gzip
+import json
+import os
+import tempfile
+import zlib
+
+import numpy as np
+
+INDEX_SUFFIX = ".idx"
+CHUNK_SIZE = 1 << 16
+
+
+def open_pdb(path, mode="r"):
+    """Open a plain or gzipped (".gz") PDB file."""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode if "b" in mode else mode + "t")
+    return open(path, mode)
+
+
+def _gzip_members(raw):
+    """Decompress `raw` gzip bytes, locating each member.
+
+    Returns
+    -------
+    text: bytes
+        decompressed content
+    members: list
+        [compressed offset, uncompressed offset] of each gzip member
+
+    """
+    members = []
+    chunks = []
+    c_off = 0
+    u_off = 0
+    raw = memoryview(raw)
+    while c_off < len(raw) and raw[c_off : c_off + 2] == b"\x1f\x8b":
+        members.append([c_off, u_off])
+        d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        pos = c_off
+        while not d.eof and pos < len(raw):
+            chunk = d.decompress(raw[pos : pos + CHUNK_SIZE])
+            pos += CHUNK_SIZE
+            chunks.append(chunk)
+            u_off += len(chunk)
+        c_off = min(pos, len(raw)) - len(d.unused_data)
+    return b"".join(chunks), members
+
+
+def _runs(lines):
+    """Group sorted line indices into (first, last) runs of consecutive ones."""
+    if len(lines) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(lines) > 1)
+    firsts = np.append(lines[0], lines[breaks + 1])
+    lasts = np.append(lines[breaks], lines[-1])
+    return list(zip(firsts.tolist(), lasts.tolist()))
+
+
+def build_index(path):
+    """Build the chain index of the PDB file `path`.
+
+    Returns
+    -------
+    index: dict
+        "chains": chain -> sorted [start, end) uncompressed byte ranges,
+        "members": gzip members (None for plain files), and the "size" and
+        "mtime_ns" of the PDB the index was built from
+
+    """
+    with open(path, "rb") as f:
+        raw = f.read()
+    if path.endswith(".gz"):
+        text, members = _gzip_members(raw)
+    else:
+        text, members = raw, None
+    lines = text.split(b"\n")
+    newlines = np.flatnonzero(np.frombuffer(text, dtype=np.uint8) == 10)
+    starts = np.concatenate([[0], newlines + 1, [len(text) + 1]])
+    table = np.array(lines, dtype="S22").view("S1").reshape(-1, 22)
+    record = table[:, :6].copy().view("S6").ravel()
+    is_atom = np.char.startswith(record, b"ATOM")
+    is_term = np.char.startswith(record, b"TER") | (record == b"CONECT")
+    term_rows = np.flatnonzero(is_term)
+
+    # column of the chain identifier of each record type
+    chain_cols = {b"SEQRES": 11, b"HELIX": 19, b"SHEET": 21}
+    chains = {}
+    for chain in np.unique(table[is_atom, 21]):
+        atom_rows = np.flatnonzero(is_atom & (table[:, 21] == chain))
+        # the ATOM block ends with the first TER/CONECT after the chain
+        stop = np.searchsorted(term_rows, atom_rows[-1])
+        last = term_rows[stop] if stop < len(term_rows) else len(lines) - 1
+        rows = [(atom_rows[0], last)]
+        for rec, col in chain_cols.items():
+            rows += _runs(
+                np.flatnonzero(
+                    np.char.startswith(record, rec) & (table[:, col] == chain)
+                )
+            )
+        # merge overlapping runs into byte ranges
+        ranges = []
+        for first, last in sorted(rows):
+            if ranges and starts[first] <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], int(starts[last + 1]))
+            else:
+                ranges.append([int(starts[first]), int(starts[last + 1])])
+        ranges[-1][1] = min(ranges[-1][1], len(text))
+        chains[chain.decode()] = ranges
+
+    st = os.stat(path)
+    return {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "members": members,
+        "chains": chains,
+    }
+
+
+def load_index(path):
+    """Load the sidecar index of `path`, (re)building it if outdated.
+
+    The index is written to a temporary file that is then renamed, so
+    concurrent readers never see a partial index; an unreadable one is
+    rebuilt as if it were outdated.
+    """
+    idx_path = path + INDEX_SUFFIX
+    st = os.stat(path)
+    if os.path.exists(idx_path):
+        try:
+            with open(idx_path, "r") as f:
+                index = json.load(f)
+            if (index["size"], index["mtime_ns"]) == (
+                st.st_size,
+                st.st_mtime_ns,
+            ):
+                return index
+        except (ValueError, KeyError, TypeError):
+            pass
+    index = build_index(path)
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(idx_path) or ".", prefix=".tmp-", suffix=".idx"
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, idx_path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return index
+
+
+def _gunzip_from(f, offset):
+    """Stream decompressed chunks of the gzip file `f` from member `offset`."""
+    f.seek(offset)
+    d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    while True:
+        data = d.unused_data or f.read(CHUNK_SIZE)
+        if not data:
+            return
+        if d.eof:
+            d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        yield d.decompress(data)
+
+
+def read_range(f, start, end, members=None):
+    """Read the uncompressed bytes [`start`, `end`) of the open PDB `f`."""
+    if members is None:
+        f.seek(start)
+        return f.read(end - start)
+    member = np.searchsorted([u for _, u in members], start, "right") - 1
+    c_off, u_off = members[member]
+    chunks = []
+    size = 0
+    for chunk in _gunzip_from(f, c_off):
+        chunks.append(chunk)
+        size += len(chunk)
+        if u_off + size >= end:
+            break
+    return b"".join(chunks)[start - u_off : end - u_off]
+
+
+def read_chain(path, chain, index=None):
+    """Read only the records of `chain` of the PDB `path`, using its index.
+
+    Returns
+    -------
+    records: bytes
+        SEQRES, HELIX and SHEET records of the chain followed by its ATOM
+        block, in file order. Empty if the chain is not in the file.
+
+    """
+    if index is None:
+        index = load_index(path)
+    ranges = index["chains"].get(chain, [])
+    with open(path, "rb") as f:
+        return b"".join(
+            read_range(f, start, end, index["members"])
+            for start, end in ranges
+        )
@@ -1,10 +1,65 @@
 """Split of data and structure to hold the graph dataset."""
+import hashlib
 import os
+from collections import namedtuple
 from glob import glob
 
 import numpy as np
+import torch
+from scipy.spatial.distance import cdist, pdist
 from sklearn.model_selection import train_test_split
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, default_collate, get_worker_info
+
+from .feature_cache import (
+    DistanceCache,
+    FeatureCache,
+    SharedFeatures,
+    cache_key,
+)
+from .graph_store import (
+    GraphStore,
+    dataset_exists,
+    graph_key,
+    read_dataset,
+    store_exists,
+)
+from .neighbors import neighbor_edges
+from .res_selector import chain_residue_index, graph_chain
+from .sampling import AugmentationSampler
+
+
+# sinusoidal encoding tables by number of dimensions, see `sequence_table`
+_SEQUENCE_TABLES = {}
+
+
+def _position_angles(positions, nb_dims):
+    """Compute the (len(positions), nb_dims) angles of the encoding."""
+    dims = np.arange(nb_dims)
+    return positions[:, None] / np.power(10000, 2 * (dims // 2) / nb_dims)
+
+
+def _sin_cos(angles):
+    """Apply sin to the even dimensions of `angles` and cos to the odd ones."""
+    angles[:, 0::2] = np.sin(angles[:, 0::2])  # dim 2i
+    angles[:, 1::2] = np.cos(angles[:, 1::2])  # dim 2i+1
+    return angles
+
+
+def sequence_table(nb_dims, max_pos=0):
+    """Get the sinusoidal encoding of the positions 0..`max_pos` (at least).
+
+    Tables are computed once per `nb_dims` and grown (doubling) when a larger
+    position is requested. Row `i` is the encoding of position `i`.
+    """
+    table = _SEQUENCE_TABLES.get(nb_dims)
+    if table is None or len(table) <= max_pos:
+        size = 1024 if table is None else 2 * len(table)
+        while size <= max_pos:
+            size *= 2
+        table = _sin_cos(_position_angles(np.arange(size), nb_dims))
+        table.flags.writeable = False
+        _SEQUENCE_TABLES[nb_dims] = table
+    return table
 
 
 class ProteinGraphDataset(Dataset):
@@ -19,6 +74,13 @@ class ProteinGraphDataset(Dataset):
         augment=1,
         fuzzy_radius=0.2,
         augmented_label=None,
+        store=None,
+        cache_dir=None,
+        padded=True,
+        residue_counts=None,
+        selection=None,
+        neighbors=None,
+        seed=None,
     ):
         """Initialize object.
 
@@ -27,7 +89,8 @@ class ProteinGraphDataset(Dataset):
         Parameters
         ----------
         data: np.array of arrays
-            each array is an instance: [0] is a path to and [1] is the label.
+            each array is an instance: [0] is a path to (or the key in
+            `store` of) the graph and [1] is the label.
         nb_nodes: int
             max size of graph (input will be padded to that size). Default: 185
         task_type: str
@@ -35,44 +98,82 @@ class ProteinGraphDataset(Dataset):
         nb_classes: 2
             number of classes
         augment, fuzzy_radius: int, float
-            parameters to apply gausian augmentation of coordinate matrix
+            parameters to apply gausian augmentation of coordinate matrix.
+            Samples are augmented by `sampler` and `JitterCollate`
         augmented_label: string
             label to augment. Default: all (None)
+        store: GraphStore
+            packed store to read the graphs from. Default: text files (None)
+        cache_dir: str
+            directory of the persistent feature cache used by `flush`.
+            Default: keep the features in memory (None)
+        padded: bool
+            zero pad samples to `nb_nodes`. If False, samples keep their
+            number of nodes, to be batched with `collate_packed` or
+            `collate_padded`.
+            Default: True
+        residue_counts: dict
+            number of residues of each graph by `data` entry, from the dataset
+            manifest. Used by `lengths` instead of reading the graphs.
+            Default: None
+        selection: dict
+            keep only the residues of some ranges of each chain, as
+            chain -> list of inclusive (first, last) sequence positions (e.g.
+            `CDR_RANGES`). See `selected_residues`. Default: all (None)
+        neighbors: Neighbors
+            connect each residue only to its neighbors (within a cutoff
+            and/or the k nearest), in sparse adjacencies. Packed batches are
+            collated with them (see `collate_packed`) and padded ones get
+            them in `nnbody.models.forward_step`. Default: all pairs of
+            residues (None)
+        seed: int
+            seed of the generator that jitters the copies read by virtual
+            index (see `__getitem__`). Default: the torch seed (None)
 
         """
         self.data = data
+        self.store = store
         self.nb_nodes = nb_nodes
         self.nb_classes = nb_classes
         self.task_type = task_type
         self.augment = augment
         self.fuzzy_radius = fuzzy_radius
+        self.cache_dir = cache_dir
+        self.padded = padded
+        self.residue_counts = residue_counts
+        self.selection = selection
+        self.neighbors = neighbors
+        # indices of the residues kept by `selection` by graph
+        self.selected = {}
+        self.generator = torch.Generator()
+        self.generator.manual_seed(
+            torch.initial_seed() if seed is None else seed
+        )
+        self.worker = None
 
-        if self.augment > 1:
-            to_augment = (
-                data[data[:, 1] == str(augmented_label)]
-                if augmented_label
-                else data
-            )
-            augment_flags = np.concatenate(
-                [
-                    np.zeros((len(self.data), 1)),
-                    np.ones((len(to_augment) * (self.augment - 1), 1)),
-                ],
-                axis=0,
-            )
-            self.data = np.concatenate(
-                [self.data]
-                + [to_augment.copy() for _ in range(self.augment - 1)],
-                axis=0,
-            )
-            self.data = np.concatenate([self.data, augment_flags], axis=-1)
+        # samples with jittered copies, see `AugmentationSampler`
+        self.to_augment = (
+            np.flatnonzero(data[:, 1] == str(augmented_label))
+            if augmented_label
+            else np.arange(len(data))
+        )
 
-        self.ident = np.eye(nb_nodes)
         self.heap = []
+        self.cache = None
+        self.cache_rows = None
+        self.distances = None
+        self.distance_rows = None
 
     def __getitem__(self, index):
         """Return index operator.
 
+        Parameters
+        ----------
+        index: int or tuple(int, int)
+            (sample, augmentation id), from `AugmentationSampler`, or a
+            virtual index: the augmented copies follow the samples, as in
+            `AugmentationSampler.virtual`, and are jittered here
+
         Return
         ------
         data: list of np.arrays
@@ -82,65 +183,120 @@ class ProteinGraphDataset(Dataset):
                 sinuisoidal tranformation about position
             c: np.array
                 centered coordinates of aminoacid (x,y,z)
-            m: np.array (matrix)
-                mask
+            m: np.array
+                node mask. The pairwise mask is built in
+                `nnbody.models.forward_step`
             y: list
                 one-hot encoding of label ("classification") or [label]
+            d: np.array
+                masked distance matrix, only if `cache_distances` was called
+            a: int
+                augmentation id (0 for the original sample), only if
+                `augment` > 1 and `index` is a tuple (the copies are then
+                jittered on collation, see `JitterCollate`)
 
         """
+        virtual = not isinstance(index, tuple)
+        if not virtual:
+            index, augmentation = index
+        elif index >= len(self.data):
+            samples, augmentations = self.sampler(False).virtual([index])
+            index, augmentation = int(samples[0]), int(augmentations[0])
+        else:
+            augmentation = 0
         if self.heap:
             # if preprocessed and stored in memory, just return it
-            return self.heap[index]
-        # Parse Protein Graph
-        data_ = []
-        with open(self.data[index][0], "r") as f:
-            for i, _ in enumerate(f):
-                if i >= self.nb_nodes:
-                    break
-                data_.append(_)
-
-        v = []
-        v_ = []
-        s = []
-        c = []
-        m = []
-        for i, line in enumerate(data_):
-            if i >= self.nb_nodes:
-                break
-            row = line[:-1].split()
-            res = np.zeros(23)
-            res[int(row[2])] = 1
-            v.append(res)
-            v_.append(row[3:5])
-            c.append(row[-3:])
-            s.append(int(row[1]))
-            m.append(int(row[0]))
-        del data_
-        v = np.array(v, dtype=float)
-        v_ = np.array(v_, dtype=float)
-        c = np.array(c, dtype=float)
-        c = c - c.mean(axis=0)  # Center on origin
-        m = np.array(m, dtype=float)
+            data_ = self.heap[index]
+        else:
+            data_ = self.sample(index)
+        if virtual:
+            return self.jitter(data_) if augmentation > 0 else data_
+        if self.augment > 1:
+            return data_ + [augmentation]
+        return data_
 
-        # Sequence Encoding
-        # s = np.array(list(range(len(v))), dtype=int)
-        p = self.sequence_encode(s, 4)
-        v = np.concatenate([v, v_, p], axis=-1)
+    def jitter(self, data_):
+        """Add gaussian noise to the coordinates of a sample [v, c, m, y, ...].
+
+        The noise is drawn from the generator of the dataset, seeded with the
+        seed of the worker in DataLoader workers, as in `JitterCollate`.
+        Cached distances are recomputed from the new coordinates.
+        """
+        info = get_worker_info()
+        if info is not None and self.worker != (info.id, info.seed):
+            self.worker = (info.id, info.seed)
+            self.generator.manual_seed(info.seed)
+        v, c, m, y, *rest = data_
+        noise = torch.randn(
+            c.shape, generator=self.generator, dtype=torch.float64
+        ).numpy()
+        c = c + self.fuzzy_radius * noise
+        if rest:
+            rest[0] = (cdist(c, c) * m[:, None] * m[None, :]).astype(
+                rest[0].dtype
+            )
+        return [v, c, m, y, *rest]
 
-        # Augment with gaussian kernel
-        if self.data.shape[-1] == 3 and self.data[index][2]:
-            random_shift = np.concatenate(
-                [
-                    np.expand_dims(
-                        np.random.normal(0.0, self.fuzzy_radius, c.shape[0]),
-                        axis=-1,
-                    )
-                    for _ in range(c.shape[-1])
-                ],
-                axis=-1,
+    def sample(self, index):
+        """Compute the features of the sample `index`, without augmentation."""
+        if self.cache is not None:
+            v, c, m = self.cache[self.cache_rows[index]]
+        else:
+            v, c, m = self.graph_features(index)
+
+        if self.distances is not None:
+            d = self.distances.matrix(
+                self.distance_rows[index],
+                self.nb_nodes if self.padded else None,
             )
-            c = c + random_shift
+        if self.padded:
+            v, c, m = self.pad(v, c, m)
 
+        if self.task_type == "classification":
+            y = [0 for _ in range(self.nb_classes)]
+            y[int(self.data[index][1])] = 1
+        elif self.task_type == "regression":
+            y = [float(self.data[index][1])]
+        else:
+            raise Exception("Task Type %s unknown" % self.task_type)
+
+        data_ = [v, c, m, y]
+        if self.distances is not None:
+            data_.append(d)
+
+        return data_
+
+    def __len__(self):
+        """Retrieve length of data, counting the augmented copies."""
+        return len(self.sampler(False))
+
+    def sampler(self, shuffle=True, seed=None):
+        """Build the `AugmentationSampler` of the dataset."""
+        return AugmentationSampler(
+            len(self.data), self.augment, self.to_augment, shuffle, seed
+        )
+
+    def lengths(self):
+        """Retrieve number of nodes of each sample (at most `nb_nodes`)."""
+        if self.selection is not None:
+            lengths = [
+                len(self.selected_residues(i)) for i in range(len(self.data))
+            ]
+        elif self.residue_counts is not None:
+            lengths = [self.residue_counts[x] for x in self.data[:, 0]]
+        elif self.cache is not None:
+            lengths = np.asarray(self.cache.arrays["n"])[self.cache_rows]
+        elif self.store is not None:
+            lengths = [self.store.index[key][1] for key in self.data[:, 0]]
+        else:
+            lengths = []
+            for path in self.data[:, 0]:
+                with open(path, "r") as f:
+                    lengths.append(sum(1 for _ in f))
+        return np.minimum(lengths, self.nb_nodes)
+
+    def pad(self, v, c, m):
+        """Zero pad the sample to `nb_nodes`."""
         # Zero Padding
         if v.shape[0] < self.nb_nodes:
             v_ = np.zeros((self.nb_nodes, v.shape[1]))
@@ -152,27 +308,64 @@ class ProteinGraphDataset(Dataset):
             v = v_
             c = c_
             m = m_
+        return v, c, m
 
-        # Set MasK
-        m = np.repeat(np.expand_dims(m, axis=-1), len(m), axis=-1)
-        m = (m * m.T) + self.ident
-        m[m > 1] = 1
+    def graph_features(self, index):
+        """Compute the unpadded node features, coordinates and node mask."""
+        # Parse Protein Graph
+        graph = self.load_graph(index)
+        v = np.zeros((len(graph), 23))
+        v[np.arange(len(graph)), graph[:, 2].astype(int)] = 1
+        v_ = graph[:, 3:5]
+        c = graph[:, -3:]
+        c = c - c.mean(axis=0)  # Center on origin
+        s = graph[:, 1].astype(int)
+        m = graph[:, 0]
 
-        if self.task_type == "classification":
-            y = [0 for _ in range(self.nb_classes)]
-            y[int(self.data[index][1])] = 1
-        elif self.task_type == "regression":
-            y = [float(self.data[index][1])]
-        else:
-            raise Exception("Task Type %s unknown" % self.task_type)
+        # Sequence Encoding
+        # s = np.array(list(range(len(v))), dtype=int)
+        p = self.sequence_encode(s, 4)
+        v = np.concatenate([v, v_, p], axis=-1)
+        return v, c, m
 
-        data_ = [v, c, m, y]
+    def load_graph(self, index):
+        """Read the graph of sample `index` as a (nodes, 10) float array.
 
-        return data_
+        Only the first `nb_nodes` residues (of the `selection`) are kept.
+        From a packed `store` and without `selection`, the graph is a
+        zero-copy slice of the memory-mapped array.
+        """
+        if self.selection is None:
+            return self.read_graph(index, self.nb_nodes)
+        graph = self.read_graph(index)
+        return graph[self.selected_residues(index, graph)][: self.nb_nodes]
 
-    def __len__(self):
-        """Retrieve length of data."""
-        return len(self.data)
+    def read_graph(self, index, nb_rows=None):
+        """Read the first `nb_rows` rows (default: all) of graph `index`."""
+        if self.store is not None:
+            return self.store[self.data[index][0]][:nb_rows]
+        rows = []
+        with open(self.data[index][0], "r") as f:
+            for i, line in enumerate(f):
+                if nb_rows is not None and i >= nb_rows:
+                    break
+                rows.append(line[:-1].split())
+        return np.array(rows, dtype=float).reshape(-1, 10)
+
+    def selected_residues(self, index, graph=None):
+        """Get the indices of the residues of sample `index` in `selection`.
+
+        They are computed once per graph from its sequence positions and
+        kept in `selected`, so changing the selection needs no new files.
+        """
+        key = self.data[index][0]
+        if key not in self.selected:
+            if graph is None:
+                graph = self.read_graph(index)
+            self.selected[key] = chain_residue_index(
+                graph[:, 1], self.selection, graph_chain(key)
+            )
+        return self.selected[key]
 
     def sequence_encode(self, seq, nb_dims):
         """Transform position index.
@@ -193,32 +386,327 @@ class ProteinGraphDataset(Dataset):
                 Sequential encoding
 
         """
-        sequence_enc = np.array(
-            [
-                [
-                    pos / np.power(10000, 2 * (j // 2) / nb_dims)
-                    for j in range(nb_dims)
-                ]
-                if pos != 0
-                else np.zeros(nb_dims)
-                for pos in seq
-            ]
-        )
-        sequence_enc[1:, 0::2] = np.sin(sequence_enc[1:, 0::2])  # dim 2i
-        sequence_enc[1:, 1::2] = np.cos(sequence_enc[1:, 1::2])  # dim 2i+1
+        seq = np.asarray(seq, dtype=int)
+        if len(seq) and seq.min() < 0:
+            sequence_enc = _sin_cos(_position_angles(seq, nb_dims))
+        else:
+            sequence_enc = sequence_table(nb_dims, seq.max(initial=0))[seq]
+        if len(seq):
+            # the first residue is not transformed (zeros for position 0)
+            sequence_enc[0] = _position_angles(seq[:1], nb_dims)
 
         return sequence_enc
 
-    def flush(self):
+    def source_hash(self, index):
+        """Hash the source graph of sample `index`."""
+        if self.store is not None:
+            source = np.ascontiguousarray(self.store[self.data[index][0]])
+        else:
+            with open(self.data[index][0], "rb") as f:
+                source = f.read()
+        return hashlib.sha256(source).hexdigest()
+
+    def feature_arrays(self, indices):
+        """Stack the padded features of samples `indices` (see FeatureCache).
+
+        Returns
+        -------
+        arrays: dict
+            "v", "c" and "m" padded to `nb_nodes`, and "n" number of nodes
+
+        """
+        arrays = {
+            "v": np.zeros((len(indices), self.nb_nodes, 29)),
+            "c": np.zeros((len(indices), self.nb_nodes, 3)),
+            "m": np.zeros((len(indices), self.nb_nodes)),
+            "n": np.zeros(len(indices), dtype=int),
+        }
+        for row, i in enumerate(indices):
+            v, c, m = self.graph_features(i)
+            arrays["v"][row, : len(v)] = v
+            arrays["c"][row, : len(c)] = c
+            arrays["m"][row, : len(m)] = m
+            arrays["n"][row] = len(v)
+        return arrays
+
+    def flush(self, shared=False):
         """Compute all feature matrices and store them in memory.
 
-        Avoid the overhead of doing it for every epoch if df is small.
+        Avoid the overhead of doing it for every epoch if df is small. With
+        `cache_dir`, the features are memory-mapped from a persistent cache
+        instead (written on the first call), which is shared by every
+        process using the same graphs, `nb_nodes` and `task_type`. Only
+        un-augmented samples are stored.
+
+        Parameters
+        ----------
+        shared: bool
+            without `cache_dir`, store the features as contiguous tensors in
+            shared memory instead of a list of samples, so DataLoader workers
+            use them without copying. Default: False
+
+        """
+        if self.cache_dir is None and not shared:
+            self.heap = [self.sample(i) for i in range(len(self.data))]
+            return
+        # repeated graphs share their features
+        _, first, rows = np.unique(
+            self.data[:, 0], return_index=True, return_inverse=True
+        )
+        if self.cache_dir is None:
+            cache = SharedFeatures(self.feature_arrays(first))
+        else:
+            hashes = [self.source_hash(i) for i in first]
+            cache = FeatureCache(
+                self.cache_dir,
+                cache_key(
+                    hashes,
+                    self.nb_nodes,
+                    self.task_type,
+                    selection=self.selection,
+                ),
+            )
+            if not cache.exists():
+                cache.write(**self.feature_arrays(first))
+        self.cache = cache
+        self.cache_rows = rows.ravel()
+
+    def cache_distances(self, dtype=np.float16, triangle=True):
+        """Precompute the masked distance matrix of every graph.
+
+        The samples then carry their masked distances (m_i * m_j * |c_i -
+        c_j|), which `nnbody.models.forward_step` passes to the models
+        instead of computing them for every batch. They are kept in a
+        `DistanceCache` of `dtype` in shared memory, as upper `triangle`s or
+        whole matrices (faster to read); float16 has a relative error of
+        ~5e-4. Augmented copies fall back to live computation from their
+        jittered coordinates (see `JitterCollate`).
         """
-        self.heap = [self[i] for i in range(len(self))]
+        _, first, rows = np.unique(
+            self.data[:, 0], return_index=True, return_inverse=True
+        )
+        sizes = []
+        triangles = []
+        for i in first:
+            if self.cache is not None:
+                _, c, m = self.cache[self.cache_rows[i]]
+            else:
+                _, c, m = self.graph_features(i)
+            # condensed (upper triangle) distances, masked
+            row, col = np.triu_indices(len(c), 1)
+            sizes.append(len(c))
+            triangles.append(pdist(c) * m[row] * m[col])
+        self.distances = DistanceCache(sizes, triangles, dtype, triangle)
+        self.distance_rows = rows.ravel()
+        if self.heap:
+            self.flush()
+
+    def share_features(self, other):
+        """Use the flushed features of `other`, which contains all graphs.
+
+        Its cached distances are shared too, if any.
+        """
+        rows = dict(zip(other.data[:, 0], other.cache_rows))
+        self.cache = other.cache
+        self.cache_rows = np.array([rows[x] for x in self.data[:, 0]])
+        if other.distances is not None:
+            rows = dict(zip(other.data[:, 0], other.distance_rows))
+            self.distances = other.distances
+            self.distance_rows = np.array([rows[x] for x in self.data[:, 0]])
+
+
+def _selection_nodes(X, selection):
+    """Upper bound of the number of residues a graph of `X` keeps."""
+    sizes = {
+        chain: sum(last - first + 1 for first, last in ranges)
+        for chain, ranges in selection.items()
+    }
+    total = sum(sizes.values())
+    return max(sizes.get(graph_chain(x), total) for x in X[:, 0])
+
+
+# batch of graphs packed as a single graph, see `collate_packed`
+PackedBatch = namedtuple(
+    "PackedBatch",
+    ["v", "c", "edges", "y", "batch_index", "dist", "nb_graphs"],
+    defaults=(None, None),
+)
+
+
+def collate_packed(samples, neighbors=None):
+    """Batch samples of a `ProteinGraphDataset(padded=False)` without padding.
+
+    The graphs are concatenated into one graph whose adjacency is block
+    diagonal, so memory scales with the number of residues instead of
+    batch size x `nb_nodes`^2. With `neighbors` (a `Neighbors` tuple), only
+    the neighbors of each residue are connected, so it scales with the
+    number of residues.
+
+    Returns
+    -------
+    batch: PackedBatch
+        v: torch.Tensor
+            (total nodes, features) concatenated node features
+        c: torch.Tensor
+            (total nodes, 3) concatenated coordinates
+        edges: torch.Tensor
+            (2, edges) sorted indices of the non-zero off-diagonal entries of
+            the block diagonal mask (pairs of masked nodes of each graph, or
+            of masked neighbors)
+        y: list of torch.Tensor
+            labels, as collated by the default DataLoader
+        batch_index: torch.Tensor
+            (total nodes,) index of the graph of each node
+        dist: torch.Tensor
+            (edges,) distances at `edges`, if the samples carry their
+            cached distances (see `ProteinGraphDataset.cache_distances`) or
+            with `neighbors`
+        nb_graphs: int
+            number of graphs, including those without nodes, which have no
+            entry in `batch_index`
+
+    """
+    sizes = [len(sample[0]) for sample in samples]
+    offsets = np.cumsum([0] + sizes[:-1])
+    edges = []
+    dist = []
+    for sample, offset in zip(samples, offsets):
+        if neighbors is not None:
+            local, local_dist = neighbor_edges(
+                sample[1], sample[2], *neighbors
+            )
+            edges.append(local + offset)
+            if len(sample) > 4:
+                local_dist = sample[4][local[0], local[1]]
+            dist.append(local_dist.astype(sample[1].dtype))
+            continue
+        local = np.flatnonzero(sample[2])
+        nodes = local + offset
+        row = np.repeat(nodes, len(nodes))
+        col = np.tile(nodes, len(nodes))
+        edges.append(np.stack([row[row != col], col[row != col]]))
+        if len(sample) > 4:
+            dist.append(sample[4][np.ix_(local, local)].ravel()[row != col])
+    return PackedBatch(
+        torch.from_numpy(np.concatenate([s[0] for s in samples])),
+        torch.from_numpy(np.concatenate([s[1] for s in samples])),
+        torch.from_numpy(np.concatenate(edges, axis=1).astype(np.int64)),
+        default_collate([s[3] for s in samples]),
+        torch.from_numpy(np.repeat(np.arange(len(samples)), sizes)),
+        torch.from_numpy(np.concatenate(dist)) if dist else None,
+        len(samples),
+    )
+
+
+def collate_padded(samples):
+    """Batch samples of a `ProteinGraphDataset(padded=False)` with padding.
+
+    Samples are zero padded only up to the longest one of the batch, which
+    is small if they have similar lengths (see `BucketBatchSampler`).
+
+    Returns
+    -------
+    batch: list
+        v, c and m as (batch, nodes, ...) tensors and y as collated by the
+        default DataLoader, followed by the (batch, nodes, nodes) cached
+        distances if the samples carry them
+
+    """
+    nb_nodes = max(len(sample[0]) for sample in samples)
+    padded = []
+    for v, c, m, y, *d in samples:
+        v_ = np.zeros((nb_nodes, v.shape[1]))
+        v_[: len(v)] = v
+        c_ = np.zeros((nb_nodes, c.shape[1]))
+        c_[: len(c)] = c
+        m_ = np.zeros(nb_nodes)
+        m_[: len(m)] = m
+        padded.append([v_, c_, m_, y])
+        if d:
+            d_ = np.zeros((nb_nodes, nb_nodes), dtype=d[0].dtype)
+            d_[: len(d[0]), : len(d[0])] = d[0]
+            padded[-1].append(d_)
+    return default_collate(padded)
+
+
+class JitterCollate:
+    """Collate samples of an augmented dataset, jittering the copies.
+
+    After batching with `collate_fn`, gaussian noise of standard deviation
+    `fuzzy_radius` is added to the coordinates of the samples with an
+    augmentation id > 0 (see `AugmentationSampler`), drawn in one go from a
+    seeded torch generator. In DataLoader workers, the generator is seeded
+    with the seed of the worker instead.
+    """
+
+    def __init__(
+        self, collate_fn=default_collate, fuzzy_radius=0.2, seed=None
+    ):
+        """Initialize collate function.
+
+        Parameters
+        ----------
+        collate_fn: function
+            `default_collate`, `collate_padded` or `collate_packed`
+        fuzzy_radius: float
+            standard deviation of the noise. Default: 0.2
+        seed: int
+            seed of the generator. Default: the torch seed (None)
+
+        """
+        self.collate_fn = collate_fn
+        self.fuzzy_radius = fuzzy_radius
+        self.generator = torch.Generator()
+        self.generator.manual_seed(
+            torch.initial_seed() if seed is None else seed
+        )
+        self.worker = None
+
+    def __call__(self, samples):
+        """Batch `samples` given as [v, c, m, y, (d), augmentation id].
+
+        Cached distances (d) of the jittered samples are recomputed from
+        their new coordinates.
+        """
+        info = get_worker_info()
+        if info is not None and self.worker != (info.id, info.seed):
+            self.worker = (info.id, info.seed)
+            self.generator.manual_seed(info.seed)
+        batch = self.collate_fn([sample[:-1] for sample in samples])
+        augmented = torch.tensor([sample[-1] > 0 for sample in samples])
+        if isinstance(batch, PackedBatch):
+            augmented = augmented[batch.batch_index]
+        c = batch[1]
+        c[augmented] += self.fuzzy_radius * torch.randn(
+            c[augmented].shape, generator=self.generator, dtype=c.dtype
+        )
+        if isinstance(batch, PackedBatch) and batch.dist is not None:
+            live = augmented[batch.edges[0]]
+            row, col = batch.edges[:, live]
+            batch.dist[live] = torch.pairwise_distance(c[row], c[col]).to(
+                batch.dist.dtype
+            )
+        elif not isinstance(batch, PackedBatch) and len(batch) > 4:
+            m = batch[2][augmented].to(c.dtype)
+            dist = torch.cdist(
+                c[augmented],
+                c[augmented],
+                compute_mode="donot_use_mm_for_euclid_dist",
+            )
+            dist *= m[:, :, None] * m[:, None, :]
+            batch[4][augmented] = dist.to(batch[4].dtype)
+        return batch
 
 
 def get_longest(path):
     """Extract max length of aminoacid in directory `path`."""
+    if dataset_exists(path):
+        lengths = read_dataset(path)["length"]
+        return int(lengths.max()) if len(lengths) else 0
+    if store_exists(path):
+        store = GraphStore(path)
+        ends = [offset + n - 1 for offset, n in store.index.values() if n]
+        return int(store.graphs[ends, 1].max()) if ends else 0
     max_aa = 0
     for file in glob(os.path.join(path, "*.txt")):
         with open(file) as f:
@@ -229,6 +717,170 @@ def get_longest(path):
     return max_aa
 
 
+def _load_examples(graph_path, data_path, packed):
+    """Read the graphs and labels of the rows of "data.csv".
+
+    With `packed` and a dataset manifest, the offsets and numbers of
+    residues of the graphs come from the manifest, without opening the
+    store; rows and labels always come from "data.csv".
+
+    Returns
+    -------
+    X, Y: np.array
+        (examples, 1) paths to (or keys in `store` of) the graphs and labels
+    store: GraphStore
+        None if not `packed`
+    residue_counts: dict
+        number of residues of each graph, if there is a dataset manifest
+
+    """
+    residue_counts = None
+    manifest = packed and dataset_exists(graph_path)
+    if manifest:
+        # the manifest lists the graphs of data.csv, without opening them
+        dataset = read_dataset(graph_path)
+        keys = [
+            graph_key(pdb_id, chain_id)
+            for pdb_id, chain_id in zip(
+                dataset["id"].tolist(), dataset["chain"].tolist()
+            )
+        ]
+        nb_residues = dataset["nb_residues"].tolist()
+        residue_counts = dict(zip(keys, nb_residues))
+        index = zip(dataset["offset"].tolist(), nb_residues)
+        store = GraphStore(graph_path, index=dict(zip(keys, index)))
+        full_index = None
+    else:
+        store = GraphStore(graph_path) if packed else None
+    X = []
+    Y = []
+    with open(os.path.join(data_path, "data.csv"), "r") as f:
+        for line in f:
+            row = line[:-1].split(",")
+            key = graph_key(row[0], row[1])
+            if packed:
+                if key not in store:
+                    if manifest:
+                        # not listed: only if it has no (non-empty) graph
+                        if full_index is None:
+                            full_index = GraphStore(graph_path).index
+                        if full_index.get(key, (0, 0))[1] > 0:
+                            raise ValueError(
+                                f"Graph {key} of data.csv is not in the "
+                                "dataset manifest; regenerate it"
+                            )
+                    continue
+                X.append(key)
+            else:
+                filename = os.path.join(graph_path, f"{key}.txt")
+                if not os.path.exists(filename):
+                    continue
+                X.append(filename)
+            Y.append(row[2])
+    X = np.expand_dims(X, axis=-1)
+    Y = np.expand_dims(Y, axis=-1)
+
+    # Get Class Compossition
+    unique, counts = np.unique(Y, return_counts=True)
+    for i in range(len(unique)):
+        print("CLASS[COUNTS]: ", unique[i], counts[i])
+
+    return X, Y, store, residue_counts
+
+
+def _k_folds(X, Y, k, seed):
+    """Shuffle the examples and split them into `k` folds."""
+    np.random.seed(seed)
+    data = np.concatenate([X, Y], axis=-1)
+    np.random.shuffle(data)
+    fs = len(data) // int(k)
+    ind = [fs * (i + 1) for i in range(len(data) // fs)]
+    remainder = len(data) % fs
+    for i in range(remainder):
+        for j in range(i % len(ind) + 1):
+            ind[-(j + 1)] += 1
+    return np.split(data.copy(), ind, axis=0)
+
+
+def _fold_split(folds, fold, valid_size, seed):
+    """Hold out `fold` as test set and split the rest into train/valid."""
+    folds = list(folds)
+    data_test = folds.pop(int(fold))
+    data_train = np.concatenate(folds, axis=0)
+    x_train, x_valid, y_train, y_valid = train_test_split(
+        data_train[:, 0:1],
+        data_train[:, 1:],
+        test_size=float(valid_size),
+        random_state=seed,
+    )
+    data_train = np.concatenate([x_train, y_train], axis=-1)
+    data_valid = np.concatenate([x_valid, y_valid], axis=-1)
+    return data_train, data_valid, data_test
+
+
+def _build_datasets(
+    data_train,
+    data_valid,
+    data_test,
+    nb_nodes,
+    task_type,
+    nb_classes,
+    augment,
+    augmented_label,
+    store,
+    residue_counts,
+    cache_dir,
+    padded,
+    selection,
+    neighbors,
+):
+    """Wrap the train/valid/test splits into ProteinGraphDatasets."""
+    # Initialize Dataset Iterators
+    train_dataset = ProteinGraphDataset(
+        data_train,
+        nb_nodes,
+        task_type,
+        nb_classes,
+        augment=augment,
+        augmented_label=augmented_label,
+        store=store,
+        residue_counts=residue_counts,
+        cache_dir=cache_dir,
+        padded=padded,
+        selection=selection,
+        neighbors=neighbors,
+    )
+    valid_dataset = ProteinGraphDataset(
+        data_valid,
+        nb_nodes,
+        task_type,
+        nb_classes,
+        augment=1,
+        store=store,
+        residue_counts=residue_counts,
+        cache_dir=cache_dir,
+        padded=padded,
+        selection=selection,
+        neighbors=neighbors,
+    )
+    test_dataset = ProteinGraphDataset(
+        data_test,
+        nb_nodes,
+        task_type,
+        nb_classes,
+        augment=augment,
+        augmented_label=augmented_label,
+        store=store,
+        residue_counts=residue_counts,
+        cache_dir=cache_dir,
+        padded=padded,
+        selection=selection,
+        neighbors=neighbors,
+    )
+
+    return train_dataset, valid_dataset, test_dataset
+
+
 def get_datasets(
     data_path,
     task_type,
@@ -239,6 +891,11 @@ def get_datasets(
     seed=1234,
     augment=1,
     augmented_label=None,
+    packed=None,
+    cache_dir=None,
+    padded=True,
+    selection=None,
+    neighbors=None,
 ):
     """Generate train/test/validation splits for proein graph data.
 
@@ -258,6 +915,21 @@ def get_datasets(
     seed: int
     augment:int
     augmented_label:string
+    packed: bool
+        read the graphs from the packed store instead of the text files.
+        Default: if the store exists (None)
+    cache_dir: str
+        directory of the persistent feature cache (see
+        `ProteinGraphDataset.flush`). Default: None
+    padded: bool
+        pad the samples to `nb_nodes`. Set to False to batch them with
+        `collate_packed` or `collate_padded`. Default: True
+    selection: dict
+        residue ranges of each chain to keep, e.g. `CDR_RANGES` for the CDR
+        loops (see `ProteinGraphDataset`). `nb_nodes` defaults to the size
+        of the ranges. Default: all residues (None)
+    neighbors: Neighbors
+        sparse neighbor graphs, see `ProteinGraphDataset`. Default: None
 
     Returns
     -------
@@ -267,52 +939,21 @@ def get_datasets(
     graph_path = os.path.join(data_path, "graph")
     if split is None:
         split = [0.7, 0.1, 0.2]
-    if nb_nodes is None:
-        nb_nodes = get_longest(graph_path)
+    if packed is None:
+        packed = store_exists(graph_path)
 
-    # Load examples
-    X = []
-    Y = []
-    with open(os.path.join(data_path, "data.csv"), "r") as f:
-        for line in f:
-            row = line[:-1].split(",")
-            pdb_id = row[0].lower()
-            chain_id = row[1].lower()
-            filename = os.path.join(graph_path, f"{pdb_id}_{chain_id}.txt")
-            if not os.path.exists(filename):
-                continue
-            X.append(filename)
-            Y.append(row[2])
-    X = np.expand_dims(X, axis=-1)
-    Y = np.expand_dims(Y, axis=-1)
-
-    # Get Class Compossition
-    unique, counts = np.unique(Y, return_counts=True)
-    for i in range(len(unique)):
-        print("CLASS[COUNTS]: ", unique[i], counts[i])
+    X, Y, store, residue_counts = _load_examples(graph_path, data_path, packed)
+    if nb_nodes is None:
+        if selection is None:
+            nb_nodes = get_longest(graph_path)
+        else:
+            nb_nodes = _selection_nodes(X, selection)
 
     if k_fold is not None:
         # Split into K Folds and return training, validation and test
-        np.random.seed(seed)
-        data = np.concatenate([X, Y], axis=-1)
-        np.random.shuffle(data)
-        fs = len(data) // int(k_fold[0])
-        ind = [fs * (i + 1) for i in range(len(data) // fs)]
-        remainder = len(data) % fs
-        for i in range(remainder):
-            for j in range(i % len(ind) + 1):
-                ind[-(j + 1)] += 1
-        folds = np.split(data.copy(), ind, axis=0)
-        data_test = folds.pop(int(k_fold[1]))
-        data_train = np.concatenate(folds, axis=0)
-        x_train, x_valid, y_train, y_valid = train_test_split(
-            data_train[:, 0:1],
-            data_train[:, 1:],
-            test_size=float(k_fold[-1]),
-            random_state=seed,
+        data_train, data_valid, data_test = _fold_split(
+            _k_folds(X, Y, k_fold[0], seed), k_fold[1], k_fold[-1], seed
         )
-        data_train = np.concatenate([x_train, y_train], axis=-1)
-        data_valid = np.concatenate([x_valid, y_valid], axis=-1)
     else:
         # Split Examples
         x_train, x_test, y_train, y_test = train_test_split(
@@ -328,25 +969,110 @@ def get_datasets(
         data_test = np.concatenate([x_test, y_test], axis=-1)
         data_valid = np.concatenate([x_valid, y_valid], axis=-1)
 
-    # Initialize Dataset Iterators
-    train_dataset = ProteinGraphDataset(
+    return _build_datasets(
         data_train,
+        data_valid,
+        data_test,
         nb_nodes,
         task_type,
         nb_classes,
-        augment=augment,
-        augmented_label=augmented_label,
+        augment,
+        augmented_label,
+        store,
+        residue_counts,
+        cache_dir,
+        padded,
+        selection,
+        neighbors,
     )
-    valid_dataset = ProteinGraphDataset(
-        data_valid, nb_nodes, task_type, nb_classes, augment=1
-    )
-    test_dataset = ProteinGraphDataset(
-        data_test,
+
+
+def get_folds(
+    data_path,
+    task_type,
+    nb_classes,
+    k,
+    valid_size=0.1,
+    nb_nodes=None,
+    seed=1234,
+    augment=1,
+    augmented_label=None,
+    packed=None,
+    cache_dir=None,
+    padded=True,
+    selection=None,
+    neighbors=None,
+    distance_dtype=None,
+):
+    """Generate the splits of all the folds of a k-fold cross-validation.
+
+    The data is read and split once, and the features of every graph are
+    computed once (see `ProteinGraphDataset.flush`) and shared by all the
+    folds: memory-mapped from the persistent cache with `cache_dir`, or in
+    shared memory otherwise, so they can be sent to other processes without
+    copying them.
+
+    Parameters
+    ----------
+    k: int
+        number of folds
+    valid_size: float
+        portion of the training folds held out for validation. Default: 0.1
+    distance_dtype: np.dtype
+        also precompute the masked distances of the graphs, stored as
+        `distance_dtype` (see `ProteinGraphDataset.cache_distances`).
+        Default: compute them for every batch (None)
+
+    The other parameters are those of `get_datasets`.
+
+    Returns
+    -------
+    folds: list of tuple(ProteinGraphDataset)
+        (train_dataset, valid_dataset, test_dataset) of each fold, the same
+        as ``get_datasets(..., k_fold=(k, fold, valid_size))``
+
+    """
+    graph_path = os.path.join(data_path, "graph")
+    if packed is None:
+        packed = store_exists(graph_path)
+
+    X, Y, store, residue_counts = _load_examples(graph_path, data_path, packed)
+    if nb_nodes is None:
+        if selection is None:
+            nb_nodes = get_longest(graph_path)
+        else:
+            nb_nodes = _selection_nodes(X, selection)
+    k_folds = _k_folds(X, Y, k, seed)
+    features = ProteinGraphDataset(
+        np.concatenate(k_folds, axis=0),
         nb_nodes,
         task_type,
         nb_classes,
-        augment=augment,
-        augmented_label=augmented_label,
+        store=store,
+        cache_dir=cache_dir,
+        selection=selection,
     )
+    features.flush(shared=True)
+    if distance_dtype is not None:
+        features.cache_distances(distance_dtype)
 
-    return train_dataset, valid_dataset, test_dataset
+    folds = []
+    for fold in range(int(k)):
+        datasets = _build_datasets(
+            *_fold_split(k_folds, fold, valid_size, seed),
+            nb_nodes,
+            task_type,
+            nb_classes,
+            augment,
+            augmented_label,
+            store,
+            residue_counts,
+            cache_dir,
+            padded,
+            selection,
+            neighbors,
+        )
+        for dataset in datasets:
+            dataset.share_features(features)
+        folds.append(datasets)
+    return folds
@@ -1,34 +1,102 @@
 """Select the given residues on a formatted file."""
+import hashlib
 import os
 
-from typing import Iterator, List, Tuple
+from typing import Dict, Iterator, List, Tuple
 
 import click
+import numpy as np
+
+# CDR loops (inclusive residue ranges) of the light and heavy chains
+CDR_RANGES = {
+    "L": [(26, 32), (49, 57), (91, 96)],
+    "H": [(26, 34), (50, 66), (93, 102)],
+}
+
+
+def residue_index(positions: np.ndarray, ranges: List[Tuple[int, int]]):
+    """Get the indices of the `positions` inside any of the `ranges`."""
+    positions = np.asarray(positions)
+    ranges = np.asarray(ranges).reshape(-1, 2)
+    inside = (positions[:, None] >= ranges[:, 0]) & (
+        positions[:, None] <= ranges[:, 1]
+    )
+    return np.flatnonzero(inside.any(axis=1))
+
+
+def chain_residue_index(
+    positions: np.ndarray, selection: Dict[str, list], chain: str
+):
+    """Get the indices of the residues of a graph selected by `selection`.
+
+    Parameters
+    ----------
+    positions: np.array
+        sequence position of each residue of the graph (its column 1)
+    selection: dict
+        chain -> list of inclusive (first, last) residue ranges
+    chain: str
+        chain of the graph. If it is not in `selection`, the graph is taken
+        as several chains, which restart their positions, and each of them
+        gets the ranges of the chains of `selection` in order (as in
+        `filter_format`)
+
+    """
+    positions = np.asarray(positions)
+    if chain in selection:
+        return residue_index(positions, selection[chain])
+    segments = np.split(
+        np.arange(len(positions)), np.flatnonzero(np.diff(positions) < 0) + 1
+    )
+    return np.concatenate(
+        [np.zeros(0, dtype=int)]
+        + [
+            segment[residue_index(positions[segment], ranges)]
+            for segment, ranges in zip(segments, selection.values())
+        ]
+    )
+
+
+def selection_tag(selection: Dict[str, list] = None) -> str:
+    """Get a short identifier of a `selection` ("" for no selection)."""
+    if selection is None:
+        return ""
+    ranges = [
+        (chain, np.asarray(chain_ranges).tolist())
+        for chain, chain_ranges in selection.items()
+    ]
+    return hashlib.sha256(repr(ranges).encode()).hexdigest()[:16]
+
+
+def graph_chain(path: str) -> str:
+    """Get the chain of a graph from its path or key ("<pdb>_<chain>")."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return stem.rsplit("_", 1)[-1].upper()
 
 
 def select_own_format(
-    lines: List[str], ranges: List[Tuple[int, int]], write: str = None
+    lines: List[str], ranges: List[Tuple[int, int]], write=None
 ):
-    """Select the residues inside `ranges` from the `target_file`.
+    """Select the residues inside `ranges` from the `lines` of a chain.
 
-    It prints the selected lines to stdout.
+    It prints the selected lines to stdout, or writes them to `write` (a
+    path, overwritten, or an open file, to add several chains to it).
     """
     s_ranges = sorted(ranges)[::-1]
     curr_range = s_ranges.pop()
-    if write is not None:
-        fout = open(write, "w")
+    fout = open(write, "w") if isinstance(write, str) else write
     for line in lines:
         # coming split_chains, the lines are guaranteed to be safe
         res = int(line.split()[1])
+        # skip the ranges already passed
+        while res > curr_range[1] and len(s_ranges) > 0:
+            curr_range = s_ranges.pop()
         if curr_range[0] <= res <= curr_range[1]:
-            if write is None:
+            if fout is None:
                 print(line, end="")
             else:
                 fout.write(line)
-        elif res > curr_range[1]:
-            if len(s_ranges) > 0:
-                curr_range = s_ranges.pop()
-    if write is not None:
+    if isinstance(write, str):
         fout.close()
 
 
@@ -53,11 +121,29 @@ def split_chains(file: str) -> Iterator[List[str]]:
     yield chain
 
 
-def filter_format(file: str, path_out: str = None):
-    """Define script function."""
-    ranges = [[26, 32], [49, 57], [91, 96]], [[26, 34], [50, 66], [93, 102]]
-    for i, chain in enumerate(split_chains(file)):
-        select_own_format(chain, ranges[i], path_out)
+def filter_format(
+    file: str, path_out: str = None, selection: Dict[str, list] = None
+):
+    """Select the residues of the CDR loops (or `selection`) of `file`.
+
+    The chain is read from the file name. Files of several chains get the
+    ranges of the chains of `selection` in order (light, then heavy).
+    """
+    if selection is None:
+        selection = CDR_RANGES
+    chain_id = graph_chain(file)
+    if chain_id in selection:
+        lines = [line for chain in split_chains(file) for line in chain]
+        chains = [(lines, selection[chain_id])]
+    else:
+        chains = zip(split_chains(file), selection.values())
+    fout = None if path_out is None else open(path_out, "w")
+    try:
+        for chain, ranges in chains:
+            select_own_format(chain, ranges, fout)
+    finally:
+        if fout is not None:
+            fout.close()
 
 
 @click.command()
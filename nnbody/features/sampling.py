@@ -0,0 +1,148 @@
+"""Batch samplers for ProteinGraphDataset."""
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class AugmentationSampler(Sampler):
+    """Sample a dataset and virtual augmented copies of some of its samples.
+
+    Index `i` of the virtual dataset maps to (sample, augmentation id): the
+    first `nb_samples` indices are the original samples (id 0), followed by
+    `augment` - 1 rounds of the samples `to_augment` (ids 1, 2...). Nothing
+    is copied, so memory does not grow with `augment`.
+    """
+
+    def __init__(
+        self, nb_samples, augment=1, to_augment=None, shuffle=True, seed=None
+    ):
+        """Initialize sampler.
+
+        Parameters
+        ----------
+        nb_samples: int
+            number of samples of the dataset
+        augment: int
+            number of times the samples `to_augment` are seen. Default: 1
+        to_augment: np.array
+            indices of the samples to augment. Default: all (None)
+        shuffle: bool
+            randomize the order. Default: True
+        seed: int
+            seed of the random generator. Default: None
+
+        """
+        self.nb_samples = nb_samples
+        self.augment = augment
+        self.to_augment = (
+            np.arange(nb_samples) if to_augment is None else to_augment
+        )
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+
+    def virtual(self, indices):
+        """Map virtual `indices` to arrays of samples and augmentation ids."""
+        samples = np.array(indices)
+        augmentations = np.zeros_like(samples)
+        augmented = samples >= self.nb_samples
+        if augmented.any():
+            copy, row = np.divmod(
+                samples[augmented] - self.nb_samples, len(self.to_augment)
+            )
+            samples[augmented] = self.to_augment[row]
+            augmentations[augmented] = copy + 1
+        return samples, augmentations
+
+    def __iter__(self):
+        """Yield (sample, augmentation id) tuples."""
+        order = np.arange(len(self))
+        if self.shuffle:
+            order = self.rng.permutation(order)
+        samples, augmentations = self.virtual(order)
+        return zip(samples.tolist(), augmentations.tolist())
+
+    def __len__(self):
+        """Retrieve number of samples, counting augmented copies."""
+        return self.nb_samples + (self.augment - 1) * len(self.to_augment)
+
+
+class BucketBatchSampler(Sampler):
+    """Batch together samples of similar number of residues.
+
+    Samples are sorted by length and the sorted order is cut into buckets of
+    `bucket_batches` batches. When shuffling, ties in length are broken at
+    random, samples are shuffled within each bucket before being batched and
+    the batches of all buckets are shuffled, so every epoch sees different
+    batches that still have little padding.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        shuffle=True,
+        bucket_batches=20,
+        seed=None,
+        augmentation=None,
+    ):
+        """Initialize sampler.
+
+        Parameters
+        ----------
+        lengths: np.array
+            number of nodes of each sample (`ProteinGraphDataset.lengths`)
+        batch_size: int
+        shuffle: bool
+            randomize the batches. If False, they follow the order of length.
+            Default: True
+        bucket_batches: int
+            number of batches per bucket. Default: 20
+        seed: int
+            seed of the random generator. Default: None
+        augmentation: AugmentationSampler
+            if supplied, batch its (sample, augmentation id) tuples instead
+            of the sample indices. Default: None
+
+        """
+        self.lengths = np.asarray(lengths)
+        self.augmentation = augmentation
+        if augmentation is not None:
+            self.virtual = augmentation.virtual(np.arange(len(augmentation)))
+            self.lengths = self.lengths[self.virtual[0]]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_batches
+        self.rng = np.random.default_rng(seed)
+
+    def __iter__(self):
+        """Yield the lists of indices of each batch."""
+        order = np.arange(len(self.lengths))
+        if self.shuffle:
+            order = self.rng.permutation(order)
+        order = order[np.argsort(self.lengths[order], kind="stable")]
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start : start + self.bucket_size]
+            if self.shuffle:
+                bucket = self.rng.permutation(bucket)
+            batches += [
+                bucket[i : i + self.batch_size].tolist()
+                for i in range(0, len(bucket), self.batch_size)
+            ]
+        if self.shuffle:
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        if self.augmentation is not None:
+            samples, augmentations = self.virtual
+            batches = [
+                list(
+                    zip(samples[batch].tolist(), augmentations[batch].tolist())
+                )
+                for batch in batches
+            ]
+        return iter(batches)
+
+    def __len__(self):
+        """Retrieve number of batches."""
+        full, last = divmod(len(self.lengths), self.bucket_size)
+        return full * (self.bucket_size // self.batch_size) + int(
+            np.ceil(last / self.batch_size)
+        )
@@ -1,6 +1,8 @@
 """Expose only the models."""
+from .cross_validation import cross_validate
+from .export import export_model
 from .models import FFNN, GCN_normed, GCN_simple
-from .train import fit_network, forward_step
+from .train import LoaderConfig, fit_network, forward_step
 from .validation import Validation
 
 __all__ = [
@@ -11,4 +13,7 @@ __all__ = [
     "forward_step",
     "sparsize",
     "Validation",
+    "LoaderConfig",
+    "cross_validate",
+    "export_model",
 ]
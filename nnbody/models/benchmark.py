@@ -0,0 +1,157 @@
+"""Benchmark the dense and sparse paths of GraphConvolution.
+
+Padded batches of k-nearest neighbor graphs (see `neighbor_adjacency`) are
+convolved both ways, forward and backward, for each number of residues and
+density of the adjacency (the degree k is the density times the residues).
+The crossover density is the fraction of non-zero adjacency entries below
+which the sparse path is faster, interpolated where the faster path flips;
+the layers interpolate the measurements of `SPARSE_CROSSOVER` by number of
+nodes.
+
+    python -m nnbody.models.benchmark -n 150,300,600,1200
+"""
+import time
+
+import click
+import numpy as np
+import pandas as pd
+import torch
+
+from nnbody.features.neighbors import Neighbors
+
+from .layers import GraphConvolution, max_sparse_density
+from .utils import neighbor_adjacency
+
+
+def time_convolution(layer, v, adj, repeats=5):
+    """Time a forward and backward pass of `layer`, in ms."""
+    times = []
+    for _ in range(repeats + 1):
+        start = time.perf_counter()
+        output, *_ = layer((v, adj))
+        output.sum().backward()
+        times.append(time.perf_counter() - start)
+    # the first pass warms up the allocator
+    return min(times[1:]) * 1e3
+
+
+def crossover(nb_graphs, nodes, densities, features=32, repeats=5, seed=0):
+    """Compare the dense and sparse convolution of random neighbor graphs.
+
+    Parameters
+    ----------
+    nb_graphs: int
+        batch size
+    nodes: Iterable[int]
+        numbers of residues of the graphs
+    densities: Iterable[float]
+        target fractions of non-zero adjacency entries; each residue gets
+        round(density x residues) neighbors (at least one)
+    features: int
+        input and output features of the layer. Default: 32
+    repeats: int
+        timed passes of each configuration; the fastest is kept. Default: 5
+    seed: int
+        seed of the coordinates, features and weights. Default: 0
+
+    Returns
+    -------
+    results: pd.DataFrame
+        time of each path (ms) and actual density of each configuration
+
+    """
+    torch.manual_seed(seed)
+    rows = []
+    for nb_nodes in nodes:
+        # residues spread in a globule of protein density
+        radius = 3 * nb_nodes ** (1 / 3)
+        c = torch.randn(nb_graphs, nb_nodes, 3)
+        c /= c.norm(dim=-1, keepdim=True)
+        c *= radius * torch.rand(nb_graphs, nb_nodes, 1) ** (1 / 3)
+        m = torch.ones(nb_graphs, nb_nodes)
+        v = torch.randn(nb_graphs, nb_nodes, features, requires_grad=True)
+        layer = GraphConvolution(features, features)
+        degrees = sorted({max(1, round(d * nb_nodes)) for d in densities})
+        for degree in degrees:
+            adj = neighbor_adjacency(c, m, Neighbors(k=degree))
+            adj = adj.detach().requires_grad_()
+            entries = nb_graphs * nb_nodes * nb_nodes
+            layer.max_density = 1.0
+            sparse = time_convolution(layer, v, adj, repeats)
+            layer.max_density = 0.0
+            dense = time_convolution(layer, v, adj, repeats)
+            rows.append(
+                {
+                    "nodes": nb_nodes,
+                    "degree": degree,
+                    "density": adj._nnz() / entries,
+                    "dense_ms": dense,
+                    "sparse_ms": sparse,
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def crossover_densities(results):
+    """Interpolate the crossover density of each number of residues.
+
+    The crossover is where the sparse path stops being faster: the density
+    at which the difference of the times of both paths changes sign,
+    linearly interpolated between the measured densities. It is NaN if the
+    faster path does not change in the measured range.
+    """
+    crossovers = {}
+    for nb_nodes, group in results.groupby("nodes"):
+        group = group.sort_values("density")
+        gap = (group["sparse_ms"] - group["dense_ms"]).to_numpy()
+        density = group["density"].to_numpy()
+        flips = np.flatnonzero((gap[:-1] < 0) & (gap[1:] >= 0))
+        if len(flips) == 0:
+            crossovers[nb_nodes] = np.nan
+            continue
+        i = flips[0]
+        t = -gap[i] / (gap[i + 1] - gap[i])
+        crossovers[nb_nodes] = density[i] + t * (density[i + 1] - density[i])
+    return pd.Series(crossovers, name="crossover").rename_axis("nodes")
+
+
+def _int_list(ctx, param, value):
+    """Parse a comma separated list of integers."""
+    return [int(x) for x in value.split(",")]
+
+
+def _float_list(ctx, param, value):
+    """Parse a comma separated list of floats."""
+    return [float(x) for x in value.split(",")]
+
+
+@click.command()
+@click.option(
+    "-n",
+    "--nodes",
+    default="150,300,600,1200",
+    callback=_int_list,
+    help="Comma separated numbers of residues",
+)
+@click.option(
+    "-d",
+    "--densities",
+    default="0.01,0.015,0.02,0.025,0.03,0.04",
+    callback=_float_list,
+    help="Comma separated densities of the adjacencies",
+)
+@click.option("-b", "--batch-size", type=int, default=16)
+@click.option("-f", "--features", type=int, default=32)
+@click.option("-r", "--repeats", type=int, default=5)
+def main(nodes, densities, batch_size, features, repeats):
+    """Print the dense-vs-sparse timings and crossover densities."""
+    results = crossover(batch_size, nodes, densities, features, repeats)
+    print(results.to_string(index=False, float_format="{:.4g}".format))
+    summary = crossover_densities(results).to_frame()
+    summary["threshold"] = [max_sparse_density(n) for n in summary.index]
+    print("Crossover density by residues and threshold of the layers:")
+    print(summary.to_string(float_format="{:.4g}".format))
+
+
+if __name__ == "__main__":
+    main()
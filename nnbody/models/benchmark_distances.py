@@ -0,0 +1,197 @@
+"""Check and benchmark `pairwise_eucl` against `batched_eucl`.
+
+The distances of random globules are computed by `batched_eucl` (the
+reference), `pairwise_eucl` with `torch.cdist`, with the Gram matrix and
+in row tiles. The check reports the largest differences of each method with
+`batched_eucl` and with float64 distances; the benchmark, the time per call
+and the peak memory (growth of the resident set, measured in a fresh
+process for each configuration) across batch sizes and residues.
+
+    python -m nnbody.models.benchmark_distances -b 8,32,128 -n 185,512
+
+The peak memory is read from /proc, so it is only measured on Linux.
+"""
+import multiprocessing
+import time
+from functools import partial
+
+import click
+import pandas as pd
+import torch
+
+from .benchmark import _int_list
+from .utils import batched_eucl, pairwise_eucl
+
+TILE_SIZE = 64
+METHODS = {
+    "batched_eucl": batched_eucl,
+    "cdist": pairwise_eucl,
+    "gram": partial(pairwise_eucl, gram=True),
+    "tiled": partial(pairwise_eucl, tile_size=TILE_SIZE),
+}
+
+
+def globules(nb_graphs, nb_nodes, seed=0):
+    """Get the coordinates of random globules of protein density."""
+    generator = torch.Generator().manual_seed(seed)
+    radius = 3 * nb_nodes ** (1 / 3)
+    c = torch.randn(nb_graphs, nb_nodes, 3, generator=generator)
+    c /= c.norm(dim=-1, keepdim=True)
+    r = torch.rand(nb_graphs, nb_nodes, 1, generator=generator)
+    c *= radius * r ** (1 / 3)
+    # far from the origin, like the coordinates of PDB files
+    return c + 100.0
+
+
+def check(nb_graphs, nodes, seed=0):
+    """Compare the distances of each method with `batched_eucl`.
+
+    Parameters
+    ----------
+    nb_graphs: int
+        batch size
+    nodes: Iterable[int]
+        numbers of residues of the graphs
+    seed: int
+        seed of the coordinates. Default: 0
+
+    Returns
+    -------
+    results: pd.DataFrame
+        largest absolute difference of each method with `batched_eucl`
+        (off the diagonal), with float64 distances and on the diagonal
+
+    """
+    rows = []
+    for nb_nodes in nodes:
+        c = globules(nb_graphs, nb_nodes, seed)
+        exact = torch.cdist(
+            c.double(), c.double(), compute_mode="donot_use_mm_for_euclid_dist"
+        )
+        off = ~torch.eye(nb_nodes, dtype=torch.bool)
+        reference = batched_eucl(c)
+        for method, func in METHODS.items():
+            dist = func(c)
+            diff = (dist - reference)[:, off]
+            diagonal = dist.diagonal(dim1=1, dim2=2)
+            rows.append(
+                {
+                    "nodes": nb_nodes,
+                    "method": method,
+                    "vs_batched": diff.abs().max().item(),
+                    "vs_float64": (dist - exact).abs().max().item(),
+                    "diagonal": diagonal.abs().max().item(),
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def _memory(field):
+    """Read the `field` ("VmRSS" or "VmHWM") of this process, in MB."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def _measure(method, nb_graphs, nb_nodes, repeats, threads):
+    """Time `method` and measure its peak memory, in MB, in this process."""
+    torch.set_num_threads(threads)
+    c = globules(nb_graphs, nb_nodes)
+    func = METHODS[method]
+    try:
+        # reset the peak resident set (VmHWM) to the current one
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    before = _memory("VmRSS")
+    times = []
+    for _ in range(repeats + 1):
+        start = time.perf_counter()
+        func(c)
+        times.append(time.perf_counter() - start)
+    # the first call warms up the allocator
+    return min(times[1:]) * 1e3, _memory("VmHWM") - before
+
+
+def benchmark(batch_sizes, nodes, repeats=5, threads=1):
+    """Time each method and measure its peak memory.
+
+    Parameters
+    ----------
+    batch_sizes: Iterable[int]
+    nodes: Iterable[int]
+        numbers of residues of the graphs
+    repeats: int
+        timed calls of each configuration; the fastest is kept. Default: 5
+    threads: int
+        intra-op threads of torch. Default: 1
+
+    Returns
+    -------
+    results: pd.DataFrame
+        time per call (ms) and peak memory growth (MB) of each method and
+        configuration
+
+    """
+    rows = []
+    context = multiprocessing.get_context("spawn")
+    for nb_graphs in batch_sizes:
+        for nb_nodes in nodes:
+            for method in METHODS:
+                with context.Pool(1) as pool:
+                    ms, mb = pool.apply(
+                        _measure,
+                        (method, nb_graphs, nb_nodes, repeats, threads),
+                    )
+                rows.append(
+                    {
+                        "batch": nb_graphs,
+                        "nodes": nb_nodes,
+                        "method": method,
+                        "ms": ms,
+                        "peak_mb": mb,
+                    }
+                )
+    return pd.DataFrame(rows)
+
+
+@click.command()
+@click.option(
+    "-b",
+    "--batch-sizes",
+    default="8,32,128",
+    callback=_int_list,
+    help="Comma separated batch sizes",
+)
+@click.option(
+    "-n",
+    "--nodes",
+    default="185,512",
+    callback=_int_list,
+    help="Comma separated numbers of residues",
+)
+@click.option("-r", "--repeats", type=int, default=5)
+@click.option("-t", "--threads", type=int, default=1)
+def main(batch_sizes, nodes, repeats, threads):
+    """Print the differences, timings and peak memory of each method."""
+    fmt = "{:.4g}".format
+    print("Largest absolute differences:")
+    print(
+        check(min(batch_sizes), nodes).to_string(index=False, float_format=fmt)
+    )
+    results = benchmark(batch_sizes, nodes, repeats, threads)
+    print(f"Time per call (ms) and peak memory (MB), {threads} thread(s):")
+    print(
+        results.pivot_table(
+            index=["batch", "nodes"],
+            columns="method",
+            values=["ms", "peak_mb"],
+        ).to_string(float_format=fmt)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""K-fold cross-validation, training the folds in parallel processes."""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+
+from .train import DataPipeline, build_loader, evaluate, fit_network
+
+
+def _available_cpus():
+    """Count the CPUs this process can run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _limit_threads(nb_threads):
+    """Limit the torch thread pools of a worker process to `nb_threads`."""
+    torch.set_num_threads(nb_threads)
+    try:
+        torch.set_num_interop_threads(nb_threads)
+    except RuntimeError:
+        # the inter-op pool was already started in this process
+        pass
+
+
+def train_fold(
+    fold,
+    datasets,
+    make_model,
+    make_optimizer,
+    criterion,
+    batch_size,
+    epochs,
+    seed,
+    save_dir,
+    packed,
+    bucketed,
+    loader_config,
+):
+    """Train the model of `fold` and evaluate it on its three splits.
+
+    The model is trained on the train split with `fit_network`, keeping the
+    weights with the lowest validation loss (saved as
+    ``<save_dir>/fold_<fold>.pt`` if `save_dir` is given).
+
+    Returns
+    -------
+    metrics: dict
+        "fold" and the loss and accuracy of each split
+    state_dict: dict
+        weights of the trained model, on the CPU
+
+    """
+    torch.manual_seed(seed + fold)
+    train, valid, test = datasets
+    model = make_model()
+    optimizer = make_optimizer(model.parameters())
+    checkpoint = False
+    if save_dir is not None:
+        checkpoint = os.path.join(save_dir, f"fold_{fold}.pt")
+    fit_network(
+        model,
+        train,
+        valid,
+        optimizer,
+        criterion,
+        batch_size,
+        epochs,
+        plot_every=epochs,  # no plots from the workers
+        save=checkpoint,
+        packed=packed,
+        bucketed=bucketed,
+        loader_config=loader_config,
+    )
+    if checkpoint and os.path.exists(checkpoint):
+        model.load_state_dict(torch.load(checkpoint))
+
+    metrics = {"fold": fold}
+    for name, dataset in zip(("train", "valid", "test"), datasets):
+        loader = DataPipeline(
+            build_loader(
+                dataset,
+                batch_size,
+                False,
+                packed,
+                bucketed,
+                seed,
+                loader_config,
+            ),
+            model.in_cuda,
+            neighbors=dataset.neighbors,
+        )
+        metrics[f"{name}_loss"], metrics[f"{name}_acc"] = evaluate(
+            model, loader, criterion
+        )
+    state_dict = {k: v.cpu() for k, v in model.state_dict().items()}
+    return metrics, state_dict
+
+
+def cross_validate(
+    folds,
+    make_model,
+    make_optimizer,
+    criterion,
+    batch_size,
+    epochs=100,
+    nb_processes=None,
+    seed=1234,
+    save_dir=None,
+    packed=False,
+    bucketed=False,
+    loader_config=None,
+    mp_context="spawn",
+):
+    """Train and evaluate every fold of a k-fold cross-validation.
+
+    The folds are trained concurrently in a pool of `nb_processes`
+    processes, each limited to its share of the available CPUs for its
+    torch threads. Build the `folds` with `nnbody.features.get_folds`, so
+    their features are computed once and shared by all processes instead of
+    being copied to each of them.
+
+    With the default "spawn" `mp_context`, the calling script must be
+    guarded by ``if __name__ == "__main__":``.
+
+    Parameters
+    ----------
+    folds: list of tuple(ProteinGraphDataset)
+        (train_dataset, valid_dataset, test_dataset) of each fold
+    make_model: callable
+        returns a new untrained model. It must be picklable (e.g.
+        ``functools.partial(GCN_simple, ...)``)
+    make_optimizer: callable
+        returns an optimizer from the parameters of the model (e.g.
+        ``functools.partial(torch.optim.Adam, lr=1e-3)``)
+    criterion: torch.nn.modules.loss
+    batch_size: int
+    epochs: int
+    nb_processes: int
+        number of folds trained at once. Default: one per fold, up to the
+        number of CPUs (None)
+    seed: int
+        the model of fold `i` is initialized with seed `seed` + `i`
+    save_dir: str
+        directory where the best model of each fold (on its validation
+        split) is saved as "fold_<i>.pt". Default: keep the weights of the
+        last epoch (None)
+    packed, bucketed, loader_config:
+        batching of the datasets, see `fit_network`. The DataLoader workers
+        of `loader_config` are started by each process
+
+    Returns
+    -------
+    metrics: pd.DataFrame
+        loss and accuracy of the train, valid and test splits of each fold
+    state_dicts: list of dict
+        weights of the model of each fold
+
+    """
+    cpus = _available_cpus()
+    if nb_processes is None:
+        nb_processes = min(len(folds), cpus)
+    if save_dir is not None:
+        os.makedirs(save_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(
+        nb_processes,
+        mp_context=mp.get_context(mp_context),
+        initializer=_limit_threads,
+        initargs=(max(1, cpus // nb_processes),),
+    ) as pool:
+        futures = [
+            pool.submit(
+                train_fold,
+                fold,
+                datasets,
+                make_model,
+                make_optimizer,
+                criterion,
+                batch_size,
+                epochs,
+                seed,
+                save_dir,
+                packed,
+                bucketed,
+                loader_config,
+            )
+            for fold, datasets in enumerate(folds)
+        ]
+        results = [future.result() for future in futures]
+
+    metrics = pd.DataFrame([m for m, _ in results]).set_index("fold")
+    summary = metrics.agg(["mean", "std"])
+    for column in metrics.columns:
+        mean, std = summary[column]
+        print(f"{column}: {mean:.4f} +/- {std:.4f}")
+    return metrics, [state_dict for _, state_dict in results]
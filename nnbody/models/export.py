@@ -0,0 +1,140 @@
+"""Export trained models for CPU inference.
+
+The exported graph takes the padded node features, coordinates and node
+masks of a batch, as in a `ProteinGraphDataset(padded=True)`, and includes
+the distance and mask preprocessing of `forward_step`. Exported models are
+run with `nnbody.serving.load_exported`, which only needs torch (or
+onnxruntime) and not the training package.
+
+ONNX export needs the optional `onnx` and `onnxscript` packages, and
+running ONNX files needs `onnxruntime` (`pip install nnbody[onnx]`).
+"""
+import copy
+
+import torch
+import torch.nn as nn
+
+from .layers import NormalizationLayer
+from .utils import masked_eucl
+
+
+class InferenceModel(nn.Module):
+    """Wrap a model to predict from (v, c, m) instead of (v, adjacency)."""
+
+    def __init__(self, model):
+        """Wrap `model` (GCN_simple, GCN_normed or FFNN)."""
+        super(InferenceModel, self).__init__()
+        self.model = model
+
+    def forward(self, v, c, m):
+        """Compute the masked distances of the batch and predict.
+
+        Parameters
+        ----------
+        v: torch.Tensor
+            (batch, nb_nodes, features) node features
+        c: torch.Tensor
+            (batch, nb_nodes, 3) coordinates
+        m: torch.Tensor
+            (batch, nb_nodes) node mask
+
+        """
+        return self.model((v.float(), masked_eucl(c.float(), m.float())))
+
+
+def _example_inputs(example):
+    """Get the (v, c, m) float tensors of a batch from the DataLoader."""
+    v, c, m = example[:3]
+    return tuple(torch.as_tensor(x).float() for x in (v, c, m))
+
+
+def export_torchscript(model, path, example):
+    """Trace `model` with its preprocessing and save it as TorchScript.
+
+    The traced graph is frozen (parameters inlined as constants) and
+    optimized for inference. The number of nodes of the inputs is fixed to
+    the one of `example`, which should be padded to `model.nb_nodes`; the
+    batch size is not.
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+        trained model, moved to the CPU
+    path: str
+        output file, usually with a ".pt" extension
+    example: tuple
+        a padded batch (v, c, m, ...) as yielded by the DataLoader
+
+    Returns
+    -------
+    module: torch.jit.ScriptModule
+        the exported module
+
+    """
+    wrapper = InferenceModel(model).eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, _example_inputs(example))
+    module = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    torch.jit.save(module, path)
+    return module
+
+
+def export_onnx(model, path, example, opset_version=17):
+    """Export `model` with its preprocessing to ONNX.
+
+    Needs the optional `onnx` package (and `onnxscript`, depending on the
+    torch version). Inputs are named "v", "c" and "m" and the output "y";
+    their first dimension (batch) is dynamic. Inputs that the model does not
+    use, like the coordinates of `FFNN`, are left out of the graph. The
+    TorchScript-based exporter is used, since `masked_eucl` writes the
+    diagonal in place, which the dynamo exporter rejects.
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+        trained model, moved to the CPU
+    path: str
+        output file, usually with a ".onnx" extension
+    example: tuple
+        a padded batch (v, c, m, ...) as yielded by the DataLoader
+    opset_version: int
+        ONNX opset. Default: 17
+
+    """
+    try:
+        import onnx  # noqa: F401
+    except ImportError as e:
+        raise ImportError(
+            "ONNX export needs the optional 'onnx' and 'onnxscript' "
+            "packages: pip install onnx onnxscript"
+        ) from e
+    wrapper = InferenceModel(model).eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            _example_inputs(example),
+            path,
+            input_names=["v", "c", "m"],
+            output_names=["y"],
+            dynamic_axes={name: {0: "batch"} for name in ("v", "c", "m", "y")},
+            opset_version=opset_version,
+            dynamo=False,
+        )
+
+
+def export_model(model, path, example):
+    """Export a CPU copy of `model`, to ONNX if `path` ends with ".onnx".
+
+    Other paths get TorchScript. See `export_torchscript` and `export_onnx`.
+    `model` itself is left on its device and in its training mode. Chunked
+    normalizations are exported unchunked, with the same outputs, since
+    their autograd Function cannot be traced.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    for layer in model.modules():
+        if isinstance(layer, NormalizationLayer):
+            layer.chunk_size = None
+    if path.endswith(".onnx"):
+        export_onnx(model, path, example)
+    else:
+        export_torchscript(model, path, example)
@@ -1,24 +1,108 @@
 """Custom layers for graph convolutional neural networks."""
 import math
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from .utils import block_dense, sparse_matmul
+
+# (nodes, crossover density): largest fraction of non-zero entries of a
+# padded batch of sparse adjacencies for which the sparse path is faster,
+# median of three runs of `nnbody.models.benchmark` (batch 16, 32 features,
+# one thread)
+SPARSE_CROSSOVER = ((150, 0.019), (300, 0.019), (600, 0.020), (1200, 0.019))
+# added to the squared widths of the gaussians, as to not divide by zero
+EPS = 0.00001
+
+
+def max_sparse_density(nb_nodes):
+    """Get the crossover density of graphs of `nb_nodes`.
+
+    Interpolated in log-log scale between the `SPARSE_CROSSOVER`
+    measurements, and constant outside of them.
+    """
+    nodes, density = np.log(SPARSE_CROSSOVER).T
+    return float(np.exp(np.interp(np.log(nb_nodes), nodes, density)))
+
+
+def _gaussian(adj, c1, c2):
+    """Compute exp(-adj^2 / (2 (c2_j + c1_i)^2)) and the inverse width."""
+    c = c2.transpose(-1, -2) + c1
+    k = 1 / (2 * c * c + EPS)
+    return torch.exp(-((adj * adj) * k)), c, k
+
+
+class ChunkedNormalization(torch.autograd.Function):
+    """Gaussian normalization of a dense adjacency, computed by row chunks.
+
+    Only (batch, chunk_size, nodes) temporaries are alive at a time, in the
+    forward and in the backward pass, which recomputes the gaussians of each
+    chunk from the saved adjacency and (batch, nodes, 1) widths instead of
+    keeping the intermediate tensors of autograd.
+    """
+
+    @staticmethod
+    def forward(ctx, adj, c1, c2, chunk_size):
+        """Normalize the (batch, nodes, nodes) `adj` by chunks of rows."""
+        norm_adj = torch.empty_like(adj)
+        for start in range(0, adj.shape[-2], chunk_size):
+            rows = slice(start, start + chunk_size)
+            norm_adj[..., rows, :] = _gaussian(
+                adj[..., rows, :], c1[..., rows, :], c2
+            )[0]
+        ctx.save_for_backward(adj, c1, c2)
+        ctx.chunk_size = chunk_size
+        return norm_adj
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        """Backpropagate to `adj`, `c1` and `c2`, chunk by chunk."""
+        adj, c1, c2 = ctx.saved_tensors
+        grad_adj = torch.empty_like(adj)
+        grad_c1 = torch.empty_like(c1)
+        grad_c2 = torch.zeros_like(c2)
+        for start in range(0, adj.shape[-2], ctx.chunk_size):
+            rows = slice(start, start + ctx.chunk_size)
+            chunk = adj[..., rows, :]
+            norm, c, k = _gaussian(chunk, c1[..., rows, :], c2)
+            grad = grad_output[..., rows, :] * norm
+            grad_adj[..., rows, :] = -2 * grad * chunk * k
+            # d/dc of -adj^2 k = 4 adj^2 c k^2
+            grad_c = 4 * grad * chunk * chunk * c * k * k
+            grad_c1[..., rows, :] = grad_c.sum(-1, keepdim=True)
+            grad_c2 += grad_c.sum(-2).unsqueeze(-1)
+        return grad_adj, grad_c1, grad_c2, None
+
 
 class GraphConvolution(nn.Module):
     """Simple GCN layer.
 
     Adaped from https://github.com/CrivelliLab/Protein-Structure-DL/
+
+    Sparse adjacencies of padded batches (block diagonal, see
+    `neighbor_adjacency`) are multiplied as sparse if at most `max_density`
+    of the entries of their blocks are non-zero, and densified into
+    (batch, nodes, nodes) otherwise. By default, `max_density` is the
+    crossover density measured for the number of nodes of the batch (see
+    `max_sparse_density`).
     """
 
     def __init__(
-        self, in_features, out_features, dropout=0.1, bias=False, act=F.relu,
+        self,
+        in_features,
+        out_features,
+        dropout=0.1,
+        bias=False,
+        act=F.relu,
+        max_density=None,
     ):
         """Initialize layer."""
         super(GraphConvolution, self).__init__()
         self.in_features = in_features
         self.out_features = out_features
+        self.max_density = max_density
         self.weight = nn.Parameter(torch.Tensor(in_features, out_features))
         if bias:
             self.bias = nn.Parameter(torch.Tensor(1, 1, out_features))
@@ -34,21 +118,31 @@ class GraphConvolution(nn.Module):
             self.bias.data.uniform_(-stdv, stdv)
 
     def forward(self, input):
-        """Pass forward features `v` and sparse adjacency matrix `adj`."""
-        v, adj = input
+        """Pass forward features `v` and sparse adjacency matrix `adj`.
+
+        Further elements of `input` (the batch index of packed batches) are
+        passed through.
+        """
+        v, adj, *rest = input
         support = torch.matmul(v, self.weight)
         s_shape = support.shape
-        in_batch = len(s_shape) > 2
-        if in_batch and adj.is_sparse:
-            support = torch.cat([matrix for matrix in support])
-        if adj.is_sparse:
-            output = torch.spmm(adj, support)
-        else:
+        if not adj.is_sparse:
             output = torch.matmul(adj, support)
-        output = output.reshape(s_shape)
+        elif len(s_shape) > 2 and self.densify(adj, s_shape[0], s_shape[1]):
+            output = torch.matmul(block_dense(adj, s_shape[1]), support)
+        else:
+            output = sparse_matmul(adj, support.reshape(-1, s_shape[-1]))
+            output = output.reshape(s_shape)
         if self.bias is not None:
-            output = output + self.bias
-        return output, adj
+            output = output + self.bias.reshape(-1)
+        return (output, adj, *rest)
+
+    def densify(self, adj, nb_graphs, nb_nodes):
+        """Check if the sparse block diagonal `adj` is too dense for spmm."""
+        density = adj._nnz() / (nb_graphs * nb_nodes * nb_nodes)
+        if self.max_density is None:
+            return density > max_sparse_density(nb_nodes)
+        return density > self.max_density
 
     def __repr__(self):
         """Stringify as typical torch layer."""
@@ -62,9 +156,22 @@ class NormalizationLayer(nn.Module):
     """Normalization layer for the adjacency matrix.
 
     Adaped from https://github.com/CrivelliLab/Protein-Structure-DL/
+
+    Sparse adjacencies are normalized only on their edges and diagonal.
+    Dense ones are normalized at once or, with `chunk_size`, by chunks of
+    rows with the same outputs and gradients (see `ChunkedNormalization`),
+    so that the peak memory does not grow with several (batch, nodes,
+    nodes) temporaries.
     """
 
-    def __init__(self, in_features, bias=False, D=100.0, apply_mask=None):
+    def __init__(
+        self,
+        in_features,
+        bias=False,
+        D=100.0,
+        apply_mask=None,
+        chunk_size=None,
+    ):
         """Initialize layer."""
         super(NormalizationLayer, self).__init__()
         self.in_features = in_features
@@ -74,12 +181,30 @@ class NormalizationLayer(nn.Module):
         self.weight2 = nn.Linear(in_features, 1, bias)
         self.in_feat = in_features
         self.d = D
+        self.chunk_size = chunk_size
 
     def forward(self, input):
-        """Normalize sparse adjacency matrix `adj` in terms of `v`."""
-        v, adj = input
+        """Normalize sparse adjacency matrix `adj` in terms of `v`.
+
+        If `adj` is a sparse tensor (packed batches or neighbor graphs), only
+        its stored entries and the diagonal are normalized, with the values
+        of the dense normalization at those entries. The rest stay 0: with
+        all neighbors and no masked nodes, the output equals the dense one,
+        but pairs with a masked (padding) node, which are exp(0) = 1 in the
+        dense normalization, are not connected. Further elements of `input`
+        are passed through.
+        """
+        v, adj, *rest = input
         c1 = self.weight1(v)
         c2 = self.weight2(v)
+        if adj.is_sparse:
+            return (v, self.normalize_edges(adj, c1, c2), *rest)
+        if self.chunk_size is not None:
+            shape = adj.shape
+            if len(c2.shape) == 2:
+                adj, c1, c2 = adj[None], c1[None], c2[None]
+            norm_adj = ChunkedNormalization.apply(adj, c1, c2, self.chunk_size)
+            return (v, norm_adj.reshape(shape), *rest)
         if len(c2.shape) > 2:
             c = c2.permute(0, 2, 1) + c1
         #     c = (
@@ -93,7 +218,31 @@ class NormalizationLayer(nn.Module):
         c = 1 / (2 * c * c + 0.00001)
 
         norm_adj = torch.exp(-((adj * adj) * c))
-        return v, norm_adj
+        return (v, norm_adj, *rest)
+
+    def normalize_edges(self, adj, c1, c2):
+        """Normalize the stored entries of the sparse `adj`.
+
+        Memory is O(edges): the widths are gathered for the nodes of each
+        edge. 3D `v` goes with a block diagonal (batch x nodes) adjacency.
+        Neighbor graphs do not store self loops, so the diagonal is added
+        (with 0 where it is missing) and normalized like in the dense path.
+        """
+        loops = torch.arange(adj.shape[0], device=adj.device)
+        adj = adj + torch.sparse_coo_tensor(
+            torch.stack([loops, loops]),
+            torch.zeros(len(loops), dtype=adj.dtype, device=adj.device),
+            adj.shape,
+        )
+        adj = adj.coalesce()
+        c1, c2 = c1.reshape(-1), c2.reshape(-1)
+        row, col = adj.indices()
+        c = c2[col] + c1[row]
+        c = 1 / (2 * c * c + EPS)
+        values = torch.exp(-((adj.values() * adj.values()) * c))
+        return torch.sparse_coo_tensor(
+            adj.indices(), values, adj.shape, is_coalesced=True
+        )
 
     def __repr__(self):
         """Stringify as typical torch layer."""
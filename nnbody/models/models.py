@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from .layers import GraphConvolution, NormalizationLayer
+from .utils import pad_nodes, to_padded
 
 
 class GCN_simple(nn.Module):
@@ -18,7 +19,7 @@ class GCN_simple(nn.Module):
         bias=False,
         act=F.relu,
         cuda=False,
-        out_act=lambda x: x,
+        out_act=None,
     ):
         """Initialize GCN model.
 
@@ -38,6 +39,9 @@ class GCN_simple(nn.Module):
             activation function. Default: F.relu
         cuda: bool
             important to correctly sparsize
+        out_act: callable
+            activation of the output. Modules (not lambdas) keep the model
+            exportable (see `nnbody.models.export`). Default: identity
 
         """
         super(GCN_simple, self).__init__()
@@ -51,8 +55,10 @@ class GCN_simple(nn.Module):
         # self.out_layer = nn.Sequential(
         #     nn.Flatten(), nn.Linear(nb_nodes * hidden[-1], label)
         # )
+        self.nb_nodes = nb_nodes
         self.in_cuda = cuda
-        self.out_act = out_act
+        # a module, not a lambda, so that the model can be exported
+        self.out_act = nn.Identity() if out_act is None else out_act
 
     def forward(self, input):
         """Pass forward GCN model.
@@ -64,12 +70,23 @@ class GCN_simple(nn.Module):
                 3D Tensor containing the features of nodes
             adj: torch.Tensor
                 3D tensor with the values of the adjacency matrix
+            batch_index: torch.Tensor, optional
+                for packed batches (2D `v`, sparse `adj`), graph of each node
+            nb_graphs: int, optional
+                for packed batches, number of graphs (some may have no nodes)
 
         """
-        v, adj = input
+        v, adj, *rest = input
         input = [v, adj]
         x, _ = self.hidden_layers.forward(input)
         x = x.sum(axis=-1)
+        # padding nodes have no edges, so they only get the last bias
+        bias = self.hidden_layers[-1].bias
+        pad = 0.0 if bias is None else bias.sum()
+        if rest:
+            x = to_padded(x, rest[0], self.nb_nodes, pad, *rest[1:])
+        else:
+            x = pad_nodes(x, self.nb_nodes, pad)
         x = self.out_layer(x)
         return self.out_act(x)
 
@@ -77,6 +94,10 @@ class GCN_simple(nn.Module):
 class GCN_normed(nn.Module):
     """Simplest GCN model."""
 
+    # the normalization weighs the pairs with padding nodes, so the outputs
+    # depend on how far each batch is padded, see `check_batching`
+    padded_only = True
+
     def __init__(
         self,
         feats,
@@ -88,6 +109,7 @@ class GCN_normed(nn.Module):
         act=F.relu,
         D=1,
         cuda=False,
+        chunk_size=None,
     ):
         """Initialize GCN model.
 
@@ -109,14 +131,19 @@ class GCN_normed(nn.Module):
             initial diameter for normalization
         cuda: bool
             important to correctly sparsize
+        chunk_size: int
+            normalize dense adjacencies by chunks of this many rows, bounding
+            the memory of the normalization (see `NormalizationLayer`).
+            Default: all rows at once (None)
 
         """
         super(GCN_normed, self).__init__()
+        self.nb_nodes = nb_nodes
         self.in_cuda = cuda
         hidden = [hidden] if isinstance("hidden", int) else hidden
         gc_layers = [
             nn.Sequential(
-                NormalizationLayer(in_dim, D=D),
+                NormalizationLayer(in_dim, D=D, chunk_size=chunk_size),
                 GraphConvolution(in_dim, out_dim, dropout, bias, act),
             )
             for in_dim, out_dim in zip([feats] + hidden[:-1], hidden)
@@ -135,11 +162,27 @@ class GCN_normed(nn.Module):
             v: torch.Tensor
                 3D Tensor containing the features of nodes
             adj: torch.Tensor
-                3D tensor with the values of the adjacency matrix
+                3D tensor with the values of the adjacency matrix, dense
+
+        Unlike GCN_simple, outputs depend on the padding: the normalization
+        gives the pairs with a padding node a weight of exp(0) = 1. Batches
+        must then be padded to `nb_nodes`, with a dense adjacency; packed
+        batches, batches padded to their longest graph and sparse neighbor
+        adjacencies, which leave those pairs unconnected, raise a ValueError.
 
         """
-        v, adj = input
-        x, _ = self.hidden_layers.forward(input)
+        v, adj, *_ = input
+        if v.dim() != 3 or v.shape[1] != self.nb_nodes:
+            raise ValueError(
+                "GCN_normed needs batches padded to nb_nodes "
+                f"({self.nb_nodes}); its outputs depend on the padding"
+            )
+        if adj.is_sparse:
+            raise ValueError(
+                "GCN_normed needs dense adjacencies: sparse (neighbor) ones "
+                "leave the pairs with padding nodes out of the normalization"
+            )
+        x, _ = self.hidden_layers.forward((v, adj))
         x = self.out_layer(x)
         return x
 
@@ -155,7 +198,7 @@ class FFNN(nn.Module):
         nb_nodes,
         dropout,
         cuda=False,
-        out_act=lambda x: x,
+        out_act=None,
     ):
         """Initialize FFNN model.
 
@@ -174,6 +217,8 @@ class FFNN(nn.Module):
         dropout: float
         cuda: bool
             important to correctly sparsize
+        out_act: callable
+            activation of the output, see `GCN_simple`. Default: identity
 
         """
         super(FFNN, self).__init__()
@@ -188,8 +233,10 @@ class FFNN(nn.Module):
         self.out_layer = nn.Sequential(
             nn.Flatten(), nn.Linear(nb_nodes * hidden[-1], label)
         )
+        self.nb_nodes = nb_nodes
         self.in_cuda = cuda
-        self.out_act = out_act
+        # a module, not a lambda, so that the model can be exported
+        self.out_act = nn.Identity() if out_act is None else out_act
 
     def forward(self, input):
         """Pass forward GCN model.
@@ -201,9 +248,19 @@ class FFNN(nn.Module):
                 3D Tensor containing the features of nodes
             adj: torch.Tensor
                 3D tensor with the values of the adjacency matrix
+            batch_index: torch.Tensor, optional
+                for packed batches (2D `v`), graph of each node
+            nb_graphs: int, optional
+                for packed batches, number of graphs (some may have no nodes)
 
         """
-        v, adj = input
+        v, adj, *rest = input
         x = self.hidden_layers.forward(v)
+        if rest or v.shape[1] < self.nb_nodes:
+            pad = self.hidden_layers.forward(v.new_zeros(1, v.shape[-1]))[0]
+            if rest:
+                x = to_padded(x, rest[0], self.nb_nodes, pad, *rest[1:])
+            else:
+                x = pad_nodes(x, self.nb_nodes, pad)
         x = self.out_layer(x)
         return self.out_act(x)
@@ -1,42 +1,330 @@
 """Training loop."""
 
 import sys
+import time
+from collections import namedtuple
+from functools import partial
+from queue import Full, Queue
+from threading import Event, Thread
 
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import BatchSampler, DataLoader, default_collate
 
+from nnbody.features import (
+    BucketBatchSampler,
+    JitterCollate,
+    PackedBatch,
+    collate_packed,
+    collate_padded,
+)
 from nnbody.visualization import plot_epoch
 
-from .utils import calc_accuracy, batched_eucl, transform_input
+from .utils import (
+    calc_accuracy,
+    masked_eucl,
+    neighbor_adjacency,
+    packed_eucl,
+    transform_input,
+)
 
+# DataLoader settings of fit_network and Validation, see `build_loader`
+LoaderConfig = namedtuple(
+    "LoaderConfig",
+    [
+        "num_workers",
+        "persistent_workers",
+        "prefetch_factor",
+        "pin_memory",
+        "background",
+    ],
+    defaults=(0, False, 2, False, False),
+)
+# model inputs and labels of a batch, ready for the model
+PreparedBatch = namedtuple("PreparedBatch", ["inputs", "labels"])
 
-def forward_step(batch, model, training):
+
+def prepare_batch(batch, in_cuda=False, training=True, neighbors=None):
+    """Build the model inputs of a `batch` from the DataLoader.
+
+    Moves the batch to the device and computes its masked distances, unless
+    the batch carries them (see `ProteinGraphDataset.cache_distances`).
+    With `neighbors` (a `Neighbors` tuple), the adjacency only holds the
+    distances between neighbors, as a sparse block diagonal matrix of
+    (batch x nodes, batch x nodes) for padded batches. `GCN_normed` refuses
+    them: pairs with a masked node, which its dense normalization weighs
+    with exp(0) = 1, are not connected (see `NormalizationLayer`).
+
+    Returns
+    -------
+    batch: PreparedBatch
+        inputs: (v, adjacency) or, for a `PackedBatch`, (v, sparse block
+        diagonal adjacency, batch_index, nb_graphs); and one-hot labels
+
+    """
+    _, _, m, _ = batch[:4]
+    inputs, labels_onehot = transform_input(batch[:4], training)
+    v, c = inputs
+    if in_cuda:
+        v, c = v.cuda(non_blocking=True), c.cuda(non_blocking=True)
+        labels_onehot = labels_onehot.cuda(non_blocking=True)
+        m = m.cuda(non_blocking=True)
+    if isinstance(batch, PackedBatch):
+        # m holds the edges: distances only between masked nodes of a graph
+        index = batch.batch_index.to(v.device)
+        if neighbors is not None:
+            # nodes with edges are the masked ones
+            nodes = torch.zeros(len(v), device=v.device)
+            nodes[m[0]] = 1
+            adj = neighbor_adjacency(c, nodes, neighbors, index)
+        elif batch.dist is None:
+            adj = packed_eucl(c, m)
+        else:
+            adj = torch.sparse_coo_tensor(
+                m, batch.dist.to(v.device).float(), (len(v), len(v))
+            ).coalesce()
+        inputs = v, adj, index, batch.nb_graphs
+    elif neighbors is not None:
+        inputs = v, neighbor_adjacency(c, m, neighbors)
+    elif len(batch) > 4:
+        # cached masked distances
+        inputs = v, batch[4].to(v.device, non_blocking=True).float()
+    else:
+        # compute pairwise distance and apply mask
+        inputs = v, masked_eucl(c, m.float())
+    return PreparedBatch(inputs, labels_onehot)
+
+
+def forward_step(batch, model, training, neighbors=None):
     """Pass forward.
 
     Paramters
     ---------
-    batch: tuple(torch.Tensor)
-        from DataLoader
+    batch: tuple(torch.Tensor), PackedBatch or PreparedBatch
+        from DataLoader. A `PackedBatch` (from `collate_packed`) is passed
+        to the model as (v, sparse block diagonal adjacency, batch_index,
+        nb_graphs). A `PreparedBatch` (see `DataPipeline`) is passed as is
     model: torch.nn.Module
     training: bool
         is network training
+    neighbors: Neighbors
+        connect each node only to its neighbors, in a sparse adjacency (see
+        `prepare_batch`). Packed batches are usually collated with the
+        neighbors of their dataset instead. Default: all masked pairs (None)
     cuda: bool
 
     """
-    _, _, m, _ = batch
-    inputs, labels_onehot = transform_input(batch, training)
-    v, c = inputs
-    if model.in_cuda:
-        v, c = v.cuda(), c.cuda()
-        labels_onehot = labels_onehot.cuda()
-        m = m.cuda()
-    # compute pairwise distance and apply mask
-    inputs = v, batched_eucl(c) * m.float()
+    if not isinstance(batch, PreparedBatch):
+        batch = prepare_batch(batch, model.in_cuda, training, neighbors)
+    inputs, labels_onehot = batch
     predictions = model(inputs)
 
     return predictions, labels_onehot
 
 
+class DataPipeline:
+    """Iterate over a DataLoader, timing how long the loop waits for data.
+
+    With `background`, a thread prepares the model inputs of the next
+    batches (`prepare_batch`: device transfer and distances) while the
+    current step runs, and yields `PreparedBatch` tuples. So do padded
+    batches with `neighbors`, prepared in the loop if not in background.
+    """
+
+    def __init__(
+        self, loader, in_cuda=False, background=False, depth=2, neighbors=None
+    ):
+        """Initialize pipeline.
+
+        Parameters
+        ----------
+        loader: torch.utils.data.DataLoader
+        in_cuda: bool
+            move the batches to the GPU (only with `background`)
+        background: bool
+            prepare the batches in a background thread. Default: False
+        depth: int
+            number of batches prepared ahead. Default: 2
+        neighbors: Neighbors
+            sparse neighbor adjacencies of padded batches (see
+            `prepare_batch`). Default: None
+
+        """
+        self.loader = loader
+        self.in_cuda = in_cuda
+        self.background = background
+        self.depth = depth
+        self.neighbors = neighbors
+        self.wait_time = 0.0
+
+    def __len__(self):
+        """Retrieve number of batches."""
+        return len(self.loader)
+
+    def _prepared(self):
+        """Yield the prepared batches of a background thread."""
+        queue = Queue(maxsize=self.depth)
+        stop = Event()
+
+        def put(item):
+            """Put `item` in the queue unless the consumer stopped."""
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    if not put(self._prepare(batch)):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+
+        thread = Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = queue.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+
+    def _prepare(self, batch):
+        """Prepare `batch`, adding the neighbors of padded batches."""
+        if isinstance(batch, PackedBatch):
+            # already collated with the neighbors of the dataset
+            return prepare_batch(batch, self.in_cuda)
+        return prepare_batch(batch, self.in_cuda, neighbors=self.neighbors)
+
+    def __iter__(self):
+        """Yield batches, adding the time blocked on each to `wait_time`."""
+        self.wait_time = 0.0
+        batches = self._prepared() if self.background else iter(self.loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            finally:
+                self.wait_time += time.perf_counter() - start
+            if self.neighbors is not None and not self.background:
+                batch = self._prepare(batch)
+            yield batch
+
+
+def build_loader(
+    dataset,
+    batch_size,
+    shuffle=True,
+    packed=False,
+    bucketed=False,
+    seed=None,
+    config=None,
+):
+    """Build the DataLoader of `dataset`.
+
+    If the dataset is augmented, its augmented copies are sampled virtually
+    (`AugmentationSampler`) and jittered after collation (`JitterCollate`).
+
+    Parameters
+    ----------
+    dataset: ProteinGraphDataset
+    batch_size: int
+    shuffle: bool
+    packed: bool, default False
+        batch the graphs without padding (see `collate_packed`), connecting
+        only the `dataset.neighbors` of each node if set
+    bucketed: bool, default False
+        batch samples of similar length (see `BucketBatchSampler`), padded
+        to the longest of each batch unless `packed`
+    seed: int
+        seed of the sampling and augmentation. Default: the torch seed
+    config: LoaderConfig
+        worker processes (call `dataset.flush(shared=True)` or use a
+        `cache_dir` first so that they share one copy of the features),
+        persistence and prefetching of workers and pinned memory. Default:
+        no workers (None)
+
+    """
+    if (packed or bucketed) and dataset.padded:
+        raise ValueError("Dataset must be built with padded=False")
+    config = LoaderConfig() if config is None else config
+    if dataset.neighbors is not None:
+        collate_packed_fn = partial(
+            collate_packed, neighbors=dataset.neighbors
+        )
+    else:
+        collate_packed_fn = collate_packed
+    kwargs = {
+        "num_workers": config.num_workers,
+        "pin_memory": config.pin_memory,
+    }
+    if config.num_workers > 0:
+        kwargs["persistent_workers"] = config.persistent_workers
+        kwargs["prefetch_factor"] = config.prefetch_factor
+    if not bucketed and dataset.augment == 1:
+        return DataLoader(
+            dataset,
+            shuffle=shuffle,
+            batch_size=batch_size,
+            drop_last=False,
+            collate_fn=collate_packed_fn if packed else None,
+            **kwargs,
+        )
+    if seed is None:
+        seed = torch.initial_seed()
+    sampler = dataset.sampler(shuffle, seed)
+    if bucketed:
+        batch_sampler = BucketBatchSampler(
+            dataset.lengths(),
+            batch_size,
+            shuffle=shuffle,
+            seed=seed,
+            augmentation=sampler,
+        )
+    else:
+        batch_sampler = BatchSampler(sampler, batch_size, drop_last=False)
+    if packed:
+        collate_fn = collate_packed_fn
+    else:
+        collate_fn = collate_padded if bucketed else default_collate
+    if dataset.augment > 1:
+        collate_fn = JitterCollate(collate_fn, dataset.fuzzy_radius, seed)
+    return DataLoader(
+        dataset,
+        batch_sampler=batch_sampler,
+        collate_fn=collate_fn,
+        **kwargs,
+    )
+
+
+def check_batching(model, packed=False, bucketed=False, neighbors=None):
+    """Refuse batchings that change the outputs of `model`.
+
+    Models with `padded_only` (`GCN_normed`) weigh the padding nodes, so a
+    model trained on packed or bucketed batches, or on sparse `neighbors`
+    adjacencies, would be evaluated and exported (padded to `nb_nodes`,
+    dense) as a different function.
+    """
+    if getattr(model, "padded_only", False) and (
+        packed or bucketed or neighbors is not None
+    ):
+        raise ValueError(
+            f"{model.__class__.__name__} needs dense batches padded to "
+            "nb_nodes: packed or bucketed batches and neighbors change its "
+            "outputs"
+        )
+
+
 def run_epoch(
     model,
     iterator,
@@ -46,7 +334,7 @@ def run_epoch(
     epoch=None,
     training=True,
 ):
-    """Train an epoch."""
+    """Train an epoch or, if not `training`, only compute its loss."""
     epoch_loss = 0
     acc = 0
     n = len(iterator)
@@ -54,17 +342,32 @@ def run_epoch(
         if debug:
             sys.stdout.write(f"\rEpoch {epoch} ({i}/{n})            ")
             sys.stdout.flush()
-        predictions, labels = forward_step(batch, model, training)
-
-        loss = criterion(predictions, labels)
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        with torch.set_grad_enabled(training):
+            predictions, labels = forward_step(batch, model, training)
+            loss = criterion(predictions, labels)
+        if training:
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
         epoch_loss += loss.item()
         acc += calc_accuracy(predictions, labels)
     return epoch_loss / n, acc / n
 
 
+def evaluate(model, iterator, criterion):
+    """Compute the mean loss and accuracy of `model`, without training it."""
+    model.eval()
+    epoch_loss = 0
+    acc = 0
+    with torch.no_grad():
+        for batch in iterator:
+            predictions, labels = forward_step(batch, model, False)
+            epoch_loss += criterion(predictions, labels).item()
+            acc += calc_accuracy(predictions, labels)
+    n = len(iterator)
+    return epoch_loss / n, acc / n
+
+
 def fit_network(
     model,
     train_dataset,
@@ -76,6 +379,9 @@ def fit_network(
     plot_every=1,
     debug=False,
     save=False,
+    packed=False,
+    bucketed=False,
+    loader_config=None,
 ):
     """Run epochs of training and testing on a NN `model`.
 
@@ -96,19 +402,48 @@ def fit_network(
     save: str
         if a string is supplied the model will be saved everytime it surpasses
         the loss (on the test set) of any other model
+    packed: bool, default False
+        batch the graphs without padding (see `collate_packed`). The datasets
+        must be built with `padded=False`. Not for `GCN_normed`, see
+        `check_batching`
+    bucketed: bool, default False
+        batch samples of similar length, padded only to the longest of each
+        batch (see `BucketBatchSampler`). The datasets must be built with
+        `padded=False`. Not for `GCN_normed`
+    loader_config: LoaderConfig, default None
+        DataLoader workers, prefetching and pinned memory (see
+        `build_loader`). With `background`, the inputs of the next batches
+        are prepared in a thread while the current step runs. The total time
+        blocked waiting for data is kept in `model.wait_time` (and reported
+        at the end with `debug`)
+
+    If the datasets have `neighbors` (see `ProteinGraphDataset`), the model
+    gets sparse adjacencies that only connect neighbors (not for
+    `GCN_normed`, see `check_batching`).
 
     Returns
     -------
     model: torch.nn.Module
-        trained model
+        trained model, with the seconds blocked waiting for data of all the
+        epochs in `wait_time`
 
     """
-    trainloader = DataLoader(
-        train_dataset, shuffle=True, batch_size=batch_size, drop_last=False
-    )
-    testloader = DataLoader(
-        test_dataset, shuffle=True, batch_size=batch_size, drop_last=False,
-    )
+    for dataset in (train_dataset, test_dataset):
+        check_batching(model, packed, bucketed, dataset.neighbors)
+    config = LoaderConfig() if loader_config is None else loader_config
+    trainloader, testloader = [
+        DataPipeline(
+            build_loader(
+                dataset, batch_size, True, packed, bucketed, None, config
+            ),
+            model.in_cuda,
+            config.background,
+            neighbors=dataset.neighbors,
+        )
+        for dataset in (train_dataset, test_dataset)
+    ]
+    wait_time = 0.0
+    start = time.perf_counter()
     all_train = []
     all_test = []
     all_epochs = []
@@ -136,6 +471,12 @@ def fit_network(
             epoch,
             training=False,
         )
+        wait_time += trainloader.wait_time + testloader.wait_time
+        if debug:
+            sys.stdout.write(
+                f" blocked on data: {trainloader.wait_time:.2f} s (train), "
+                f"{testloader.wait_time:.2f} s (test)"
+            )
 
         all_train.append(tr_loss)
         acc_train.append(tr_acc)
@@ -152,4 +493,11 @@ def fit_network(
                 all_epochs, all_train, all_test, acc_train, acc_test, epoch
             )
 
+    model.wait_time = wait_time
+    if debug:
+        total = time.perf_counter() - start
+        print(
+            f"\nTime blocked on data: {wait_time:.2f} s of {total:.2f} s "
+            f"({100 * wait_time / max(total, 1e-9):.1f}%)"
+        )
     return model
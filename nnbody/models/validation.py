@@ -2,15 +2,41 @@
 import torch
 from sklearn.metrics import confusion_matrix
 
-from .train import forward_step
+from .train import (
+    DataPipeline,
+    LoaderConfig,
+    build_loader,
+    check_batching,
+    forward_step,
+)
 
 
 class Validation:
     """Run the validation and compute statistics."""
 
-    def __init__(self, trained_model, valid):
-        """Initialize."""
+    def __init__(
+        self,
+        trained_model,
+        valid,
+        packed=False,
+        bucketed=False,
+        loader_config=None,
+    ):
+        """Initialize.
+
+        With `packed` or `bucketed`, `valid` must be built with
+        `padded=False` and is batched as in `build_loader`, with the
+        `LoaderConfig` `loader_config`. Models that need batches padded to
+        `nb_nodes` (see `check_batching`) raise a ValueError.
+        """
+        check_batching(trained_model, packed, bucketed, valid.neighbors)
         self.model = trained_model
+        self.packed = packed
+        self.bucketed = bucketed
+        self.loader_config = (
+            LoaderConfig() if loader_config is None else loader_config
+        )
+        self.wait_time = 0.0
         self.prediction = []
         self.truth = []
         self.valid = valid
@@ -33,15 +59,30 @@ Strain 1                              & 140
             return "Statistics not computed."
 
     def validate(self):
-        """Run the pass forward trough the model."""
+        """Run the pass forward trough the model.
+
+        The time blocked waiting for data is kept in `wait_time`.
+        """
         self.model.eval()
-        for batch in torch.utils.data.DataLoader(
-            self.valid, shuffle=False, batch_size=1, drop_last=False
-        ):
+        batches = DataPipeline(
+            build_loader(
+                self.valid,
+                1,
+                False,
+                self.packed,
+                self.bucketed,
+                config=self.loader_config,
+            ),
+            self.model.in_cuda,
+            self.loader_config.background,
+            neighbors=self.valid.neighbors,
+        )
+        for batch in batches:
             pred, y = forward_step(batch, self.model, False)
             pred = torch.where(pred[0] == pred[0].max())[0]
             self.prediction.append(pred[0].cpu().tolist())
             self.truth.append(y[0].cpu().tolist())
+        self.wait_time = batches.wait_time
 
     def compute_stats(self):
         """Confussion matrix and related statistics."""
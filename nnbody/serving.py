@@ -0,0 +1,90 @@
+"""Run models exported by `nnbody.models.export` on the CPU.
+
+Only torch (TorchScript files) or the optional onnxruntime (".onnx" files)
+are needed: importing this module does not import the training package.
+"""
+import numpy as np
+import torch
+
+
+def _set_threads(num_threads, interop_threads):
+    """Fix the number of intra-op and inter-op threads of torch."""
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        # only settable before the first inter-op parallel work
+        pass
+
+
+class ExportedModel:
+    """Predict with an exported model from padded (v, c, m) batches."""
+
+    def __init__(self, path, num_threads=1, interop_threads=1):
+        """Load the exported model at `path`.
+
+        Parameters
+        ----------
+        path: str
+            TorchScript file or, if it ends with ".onnx", ONNX file
+        num_threads: int
+            intra-op threads. Default: 1
+        interop_threads: int
+            inter-op threads. Default: 1
+
+        """
+        self.path = path
+        self.onnx = path.endswith(".onnx")
+        if self.onnx:
+            try:
+                import onnxruntime
+            except ImportError as e:
+                raise ImportError(
+                    "Running ONNX models needs the optional 'onnxruntime' "
+                    "package: pip install onnxruntime"
+                ) from e
+
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = interop_threads
+            self.session = onnxruntime.InferenceSession(
+                path, options, providers=["CPUExecutionProvider"]
+            )
+            # unused inputs (the coordinates and mask of FFNN) are pruned
+            self.inputs = {x.name for x in self.session.get_inputs()}
+        else:
+            _set_threads(num_threads, interop_threads)
+            self.module = torch.jit.load(path, map_location="cpu")
+            self.module.eval()
+
+    def predict(self, v, c, m):
+        """Predict the batch of node features `v`, coordinates and mask.
+
+        Inputs are arrays or tensors padded to the number of nodes of the
+        model, with a leading batch dimension.
+
+        Returns
+        -------
+        y: np.array
+            (batch, labels) predictions
+
+        """
+        if self.onnx:
+            inputs = {
+                name: np.asarray(x, dtype=np.float32)
+                for name, x in zip(("v", "c", "m"), (v, c, m))
+                if name in self.inputs
+            }
+            return self.session.run(["y"], inputs)[0]
+        with torch.inference_mode():
+            y = self.module(
+                *(torch.as_tensor(x, dtype=torch.float32) for x in (v, c, m))
+            )
+        return y.numpy()
+
+    __call__ = predict
+
+
+def load_exported(path, num_threads=1, interop_threads=1):
+    """Load the exported model at `path`, see `ExportedModel`."""
+    return ExportedModel(path, num_threads, interop_threads)
@@ -22,5 +22,6 @@ setup(
         "torchvision",
         "matplotlib",
     ],
+    extras_require={"onnx": ["onnx", "onnxscript", "onnxruntime"]},
     zip_safe=False,
 )